@@ -1,29 +1,427 @@
 #!/usr/bin/env python
 
-import argparse, sys, csv
+import argparse, sys, csv, json, re, time
+import multiprocessing
+from collections import deque, OrderedDict
+from itertools import groupby
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+BLOCKSIZE = 1 << 22 # default bytes of SAM read, and filtered records written, at once by the tag engine
+REJECTS = ('nm', 'mapq', 'xa', 'sa', 'clip', 'template') # criteria records are rejected by, in the order tried
+SOFTCLIP = re.compile(rb'(\d+)S')
 
 def main():
 
     # Parse arguments.
-    parser = argparse.ArgumentParser(description='takes in SAM format input generated by BWA aligner and filters reads by edit distance. Outputs to STDOUT.')
+    parser = argparse.ArgumentParser(description='takes in SAM format input generated by BWA aligner (or BAM/CRAM) and filters reads by edit distance, and optionally MAPQ, XA/SA tags and soft clipping, in one pass. Outputs to STDOUT.')
     parser.add_argument('-i', '--input', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='indicate input.sam (leave out if using STDIN).')
     parser.add_argument('-n', '--nedit', help='indicate max edit distance allowed per read (default=10)', default=10, type=int, required=False)
-    parser.add_argument('-f', '--format', help='indicate bwa algorithm used. options: mem, sampe', default="sampe", type=str, required=False)
-    parser.add_argument('-c', '--cust', help='indicate custom field (0-based) for edit distance flag (NM:i:). Overrides --format.', type=int, required=False)   
+    parser.add_argument('-e', '--engine', help='tags (default): find the NM:i: tag among the optional fields of each record, for any aligner. Records without one are kept. columns: read NM from the fixed field set by --format/--cust, as for bwa', choices=['tags', 'columns'], default='tags', required=False)
+    parser.add_argument('-f', '--format', help='indicate bwa algorithm used, for --engine columns. options: mem, sampe', default="sampe", type=str, required=False)
+    parser.add_argument('-c', '--cust', help='indicate custom field (0-based) for edit distance flag (NM:i:), for --engine columns. Overrides --format.', type=int, required=False)
+    parser.add_argument('-F', '--informat', help='input format: sam, or bam/cram (also sam.gz) read with pysam. Detected for an input file, otherwise (STDIN) sam unless given', choices=['sam', 'bam', 'cram'], required=False)
+    parser.add_argument('-O', '--outformat', help='output format: sam (default), or bam/cram written with pysam', choices=['sam', 'bam', 'cram'], default='sam', required=False)
+    parser.add_argument('-o', '--output', help='indicate output file (default STDOUT)', default='-', required=False)
+    parser.add_argument('-r', '--reference', help='reference fasta, needed to read or write CRAM', required=False)
+    parser.add_argument('-m', '--pairs', help='read (default): keep or drop each record by its own NM. each: keep or drop whole templates (name-adjacent records), kept only if every primary mate passes. sum: keep templates whose primary mates NM sum to at most --nedit. Secondary/supplementary records follow their template', choices=['read', 'each', 'sum'], default='read', required=False)
+    parser.add_argument('-w', '--window', help='number of recent template decisions remembered for secondary/supplementary records not adjacent to their template (default=10000)', default=10000, type=int, required=False)
+    parser.add_argument('-p', '--procs', help='number of processes filtering SAM batches with the tags engine. Output keeps the input order (default=1)', default=1, type=int, required=False)
+    parser.add_argument('-b', '--batch', help='SAM batch size in MB read and filtered at once; batches end between reads so mates stay together (default=4)', default=4, type=float, required=False)
+    parser.add_argument('-t', '--threads', help='number of threads for BAM/CRAM (BGZF) compression and decompression (default=1)', default=1, type=int, required=False)
+    parser.add_argument('-Q', '--mapq', help='indicate min MAPQ of mapped records (default=0, no filter)', default=0, type=int, required=False)
+    parser.add_argument('-X', '--noxa', help='indicate True to drop records with an XA tag (alternative hits)', required=False)
+    parser.add_argument('-S', '--nosa', help='indicate True to drop records with an SA tag (chimeric/split alignments)', required=False)
+    parser.add_argument('-C', '--maxclip', help='indicate max total soft clipped bases per record (default no filter)', type=int, required=False)
+    parser.add_argument('-R', '--report', help='indicate True to print records seen, kept and rejected per criterion, and records/s, to STDERR', required=False)
+    parser.add_argument('-J', '--json', help='indicate file to write the report to as JSON', required=False)
     args = parser.parse_args()
+    start = time.time()
+    truth = ['T', 't', 'True', 'true', 'TRUE']
+    criteria = {'nedit': args.nedit, 'pairs': args.pairs, 'window': args.window, 'mapq': args.mapq,
+                'xa': args.noxa in truth, 'sa': args.nosa in truth, 'clip': args.maxclip}
+    reporting = args.report in truth or args.json
 
-    SAMin = csv.reader(args.input, delimiter = '\t', quoting=csv.QUOTE_NONE)
+    if not args.informat:
+        args.informat = 'sam' if args.input is sys.stdin else sniff_format(args.input.name)
+    if args.engine == 'columns' and (len(compile_checks(criteria)) > 1 or reporting):
+        sys.exit('Error: --engine columns only filters on NM, use the default engine for other criteria or a report!\n')
+    if args.informat != 'sam' or args.outformat != 'sam':
+        if pysam is None:
+            sys.exit('Error: BAM/CRAM input or output needs pysam installed!\n')
+        if args.engine == 'columns':
+            sys.exit('Error: --engine columns only reads SAM text, use the default engine for BAM/CRAM!\n')
+        counts = pysam_filter(args, criteria)
+        if reporting:
+            report(counts, criteria, time.time() - start, args.report in truth, args.json)
+        return
 
+    if args.engine == 'tags':
+        out = open(args.output, 'wb') if args.output != '-' else sys.stdout.buffer
+        batches = sam_batches(args.input.buffer, int(args.batch * (1 << 20)))
+        if args.procs > 1:
+            counts = parallel_filter(batches, out, args.procs, criteria)
+        else:
+            checks = compile_checks(criteria)
+            counts = dict.fromkeys(('seen', 'kept') + REJECTS, 0)
+            recent = OrderedDict() # decisions of recent templates, kept across batches
+            for batch in batches:
+                out.write(b''.join(filter_batch(batch, criteria, checks, counts, recent)))
+        out.flush()
+        if out is not sys.stdout.buffer:
+            out.close()
+        if reporting:
+            report(counts, criteria, time.time() - start, args.report in truth, args.json)
+        return
+
+    if args.output != '-':
+        sys.stdout = open(args.output, 'w')
     if args.cust:
         nmfield = args.cust
     elif "mem" in args.format and not args.cust:
         nmfield = 11
     elif "sampe" in args.format and not args.cust:
         nmfield = 12
+    column_filter(args.input, nmfield, args.nedit)
+    if args.output != '-':
+        sys.stdout.close()
+
+def compile_checks(criteria, bam=False):
+    '''the record criteria asked for as (name, check) pairs, in the order tried. check(record) is True if the record
+    passes; records are (fields, tags) from sam_record, or pysam reads with bam. NM is checked per record unless
+    summed over the template (pairs sum). Records without an NM tag pass it; unmapped records pass MAPQ.'''
+    nedit, mapq, clip = criteria['nedit'], criteria['mapq'], criteria['clip']
+    checks = []
+    if bam:
+        if criteria['pairs'] != 'sum':
+            checks.append(('nm', lambda read: not read.has_tag('NM') or read.get_tag('NM') <= nedit))
+        if mapq > 0:
+            checks.append(('mapq', lambda read: read.is_unmapped or read.mapping_quality >= mapq))
+        if criteria['xa']:
+            checks.append(('xa', lambda read: not read.has_tag('XA')))
+        if criteria['sa']:
+            checks.append(('sa', lambda read: not read.has_tag('SA')))
+        if clip is not None:
+            checks.append(('clip', lambda read: sum(n for (op, n) in (read.cigartuples or []) if op == 4) <= clip))
+        return checks
+
+    def nm_passes(record):
+        nm = tag_int(record[1], b'\tNM:i:')
+        return nm is None or nm <= nedit
+
+    if criteria['pairs'] != 'sum':
+        checks.append(('nm', nm_passes))
+    if mapq > 0:
+        checks.append(('mapq', lambda record: int(record[0][1]) & 4 or int(record[0][4]) >= mapq))
+    if criteria['xa']:
+        checks.append(('xa', lambda record: b'\tXA:Z:' not in record[1]))
+    if criteria['sa']:
+        checks.append(('sa', lambda record: b'\tSA:Z:' not in record[1]))
+    if clip is not None:
+        checks.append(('clip', lambda record: sum(int(n) for n in SOFTCLIP.findall(record[0][5])) <= clip))
+    return checks
+
+def sam_record(line):
+    '''split a SAM record line into its mandatory fields and its optional fields, the latter as bytes starting
+    with a tab so a tag is found as tab + tag.'''
+    fields = line.split(b'\t', 11)
+    return fields, (b'\t' + fields[11] if len(fields) > 11 else b'')
+
+def tag_int(tags, tag):
+    '''value of integer tag (as tab + TAG:i:) among the optional fields tags, or None if absent or not a number.'''
+    i = tags.find(tag)
+    if i < 0:
+        return None
+    end = tags.find(b'\t', i + 1)
+    try:
+        return int(tags[i + len(tag):end] if end >= 0 else tags[i + len(tag):])
+    except ValueError:
+        return None
+
+def record_fail(record, checks):
+    '''name of the first check a record fails, or None if it passes them all.'''
+    for (name, check) in checks:
+        if not check(record):
+            return name
+    return None
+
+def check_records(records, checks):
+    '''the first check each of records (from sam_record) fails, or None if passed. Truncated or malformed
+    records pass, as they do keep_record.'''
+    return [record_fail(record, checks) if well_formed(record[0]) else None for record in records]
+
+def well_formed(fields):
+    '''True if the split fields of a SAM record hold all 11 mandatory fields, with a numeric FLAG and MAPQ.'''
+    return len(fields) >= 11 and fields[1].isdigit() and fields[4].isdigit()
+
+def sam_batches(SAMin, batchsize=BLOCKSIZE):
+    '''yield binary SAM stream SAMin in batches of whole lines of about batchsize bytes. A batch never ends
+    inside a run of lines with the same QNAME, so mates (and header lines of a kind) stay together.'''
+    rest = b''
+    while True:
+        block = SAMin.read(batchsize)
+        if not block:
+            break
+        data = rest + block
+        cut = qname_cut(data)
+        if cut:
+            yield data[:cut]
+        rest = data[cut:]
+    if rest:
+        yield rest
+
+def qname_cut(data):
+    '''offset in data of the first of the complete lines sharing the QNAME of the last complete line, or 0.'''
+    end = data.rfind(b'\n') + 1
+    if not end:
+        return 0
+    cut = data.rfind(b'\n', 0, end - 1) + 1
+    tab = data.find(b'\t', cut, end)
+    qname = data[cut:tab if tab >= 0 else end] + b'\t'
+    while cut:
+        prev = data.rfind(b'\n', 0, cut - 1) + 1
+        if data[prev:prev + len(qname)] != qname:
+            break
+        cut = prev
+    return cut
+
+def filter_batch(batch, criteria, checks, counts, recent=None, defer=False):
+    '''the lines of a SAM batch to keep, as a list of bytes to write out, adding to counts the records seen, kept
+    and rejected per criterion. Records are kept if they pass checks (from compile_checks), or with pairs each/sum
+    as whole templates by template_reasons. recent maps the QNAMEs of up to window recent templates to their
+    decision, for secondary/supplementary records that turn up apart from their template; those of templates not
+    in recent are kept by their own checks, or with defer left in the list as (qname, lines) to decide later.'''
+    lines = batch.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    pairs = criteria['pairs']
+    if pairs == 'read' and [name for (name, check) in checks] == ['nm']: # NM alone, found without splitting records
+        kept = [line + b'\n' for line in lines if keep_record(line, criteria['nedit'])]
+        # as in the general path below, headers and lines without a tab (blank or malformed) are kept but are not records
+        skipped = len([1 for line in lines if b'\t' not in line or line[0] == 64]) # 64 is @
+        counts['seen'] += len(lines) - skipped
+        counts['kept'] += len(kept) - skipped
+        counts['nm'] += len(lines) - len(kept)
+        return [b''.join(kept)]
+    segments = []
+    kept = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        tab = line.find(b'\t')
+        if line[:1] == b'@' or tab < 0:
+            kept.append(line + b'\n')
+            i += 1
+            continue
+        qname = line[:tab + 1]
+        j = i + 1
+        if pairs != 'read':
+            while j < len(lines) and lines[j].startswith(qname):
+                j += 1
+        template = lines[i:j]
+        i = j
+        records = [sam_record(line) for line in template]
+        reasons = check_records(records, checks)
+        if pairs != 'read':
+            nms = [tag_int(tags, b'\tNM:i:') or 0 for (fields, tags) in records] if pairs == 'sum' else None
+            primary = [well_formed(fields) and not int(fields[1]) & 0x900 for (fields, tags) in records]
+            decided = template_reasons(reasons, primary, nms, criteria['nedit'])
+            if decided is None: # no primary record here, follow the template's decision if recent
+                keep = recent.get(qname)
+                if keep is None and defer:
+                    segments += [b''.join(kept), (qname, template)]
+                    kept = []
+                    continue
+                reasons = follow_template(reasons, keep, nms, criteria['nedit'])
+            else:
+                reasons = decided
+                remember(recent, qname, not any(reasons), criteria['window'])
+        tally(counts, reasons)
+        kept += [line + b'\n' for (line, reason) in zip(template, reasons) if reason is None]
+    segments.append(b''.join(kept))
+    return segments
+
+def template_reasons(fails, primary, nms, nedit):
+    '''decide on a template from the first check each of its records fails (None if passed) and which are primary:
+    the criterion each record is rejected by, or None for each if the template is kept. The template is dropped
+    whole if a primary record fails, or with nms (pairs sum) if the NM of its primary records (0 for those without
+    an NM tag) sum to more than nedit; records passing themselves are then counted as nm for the sum, otherwise
+    template. None if the template has no primary record.'''
+    if not any(primary):
+        return None
+    nmsum = nms is not None and sum(nm for (nm, p) in zip(nms, primary) if p) > nedit
+    if nmsum or any(fail for (fail, p) in zip(fails, primary) if p):
+        return [fail or ('nm' if nmsum else 'template') for fail in fails]
+    return [None] * len(fails)
+
+def follow_template(fails, keep, nms=None, nedit=0):
+    '''rejection criteria of records apart from their template, from its decision keep, or their own if unknown
+    (with nms, as for pairs sum, also rejecting those whose own NM is over nedit).'''
+    if keep is None:
+        if nms is not None:
+            return [fail or ('nm' if nm > nedit else None) for (fail, nm) in zip(fails, nms)]
+        return fails
+    if keep:
+        return [None] * len(fails)
+    return [fail or 'template' for fail in fails]
+
+def tally(counts, reasons):
+    '''count records seen, and kept or rejected per criterion, from the reason each was rejected (None if kept).'''
+    counts['seen'] += len(reasons)
+    for reason in reasons:
+        counts['kept' if reason is None else reason] += 1
+
+def remember(recent, qname, keep, window):
+    '''record the decision on a template, forgetting the least recently decided beyond window.'''
+    recent[qname] = keep
+    recent.move_to_end(qname)
+    if len(recent) > window:
+        recent.popitem(last=False)
+
+def parallel_filter(batches, out, procs, criteria):
+    '''filter SAM batches across procs worker processes, writing the kept lines to out in input order, and return
+    the summed counts. At most two batches per worker are in flight, so memory stays bounded however large the
+    input. Secondary/supplementary records whose template was in an earlier batch are decided here, from the
+    recent template decisions each batch returns.'''
+    checks = compile_checks(criteria)
+    counts = dict.fromkeys(('seen', 'kept') + REJECTS, 0)
+    recent = OrderedDict()
+    pool = multiprocessing.Pool(procs, initializer=init_worker, initargs=(criteria,))
+    pending = deque()
+
+    def write_batch(result):
+        segments, decisions, batch_counts = result
+        for segment in segments:
+            if isinstance(segment, tuple):
+                qname, template = segment
+                records = [sam_record(line) for line in template]
+                nms = [tag_int(tags, b'\tNM:i:') or 0 for (fields, tags) in records] if criteria['pairs'] == 'sum' else None
+                reasons = follow_template(check_records(records, checks), recent.get(qname), nms, criteria['nedit'])
+                tally(counts, reasons)
+                segment = b''.join([line + b'\n' for (line, reason) in zip(template, reasons) if reason is None])
+            out.write(segment)
+        for (qname, keep) in decisions:
+            remember(recent, qname, keep, criteria['window'])
+        for key in batch_counts:
+            counts[key] += batch_counts[key]
+
+    for batch in batches:
+        pending.append(pool.apply_async(worker_batch, (batch,)))
+        if len(pending) >= 2 * procs:
+            write_batch(pending.popleft().get())
+    while pending:
+        write_batch(pending.popleft().get())
+    pool.close()
+    pool.join()
+    return counts
+
+def init_worker(criteria):
+    '''hand each pool worker the filter criteria once, compiling its checks.'''
+    global workerSettings
+    workerSettings = (criteria, compile_checks(criteria))
+
+def worker_batch(batch):
+    '''filter a SAM batch in a pool worker, returning its segments, its last window template decisions and its counts.'''
+    criteria, checks = workerSettings
+    counts = dict.fromkeys(('seen', 'kept') + REJECTS, 0)
+    recent = OrderedDict()
+    segments = filter_batch(batch, criteria, checks, counts, recent, defer=True)
+    return (segments, list(recent.items()), counts)
+
+def keep_record(line, nedit):
+    '''True if a SAM line is a header, has no NM:i: tag or has one of at most nedit.'''
+    if line[:1] == b'@':
+        return True
+    nm = record_nm(line)
+    return nm is None or nm <= nedit
+
+def record_nm(line):
+    '''value of the NM:i: tag of a SAM record line, or None if it has none (or not a number, kept as the column engine does).'''
+    i = line.find(b'\tNM:i:')
+    while i >= 0 and line.count(b'\t', 0, i) < 10: # matched inside a mandatory field (e.g. QUAL), look further on
+        i = line.find(b'\tNM:i:', i + 1)
+    if i < 0:
+        return None
+    end = line.find(b'\t', i + 6)
+    try:
+        return int(line[i + 6:end] if end >= 0 else line[i + 6:])
+    except ValueError:
+        return None
+
+def report(counts, criteria, seconds, stderr=True, json_path=None):
+    '''print records seen, kept and rejected per criterion in play, and records/s, to STDERR and/or write them as JSON.'''
+    names = [name for (name, check) in compile_checks(criteria)] + ['nm']
+    if criteria['pairs'] != 'read':
+        names.append('template')
+    rejected = OrderedDict((name, counts[name]) for name in REJECTS if name in names)
+    rate = counts['seen'] / seconds if seconds > 0 else 0.0
+    summary = OrderedDict([('seen', counts['seen']), ('kept', counts['kept']), ('rejected', counts['seen'] - counts['kept']),
+                           ('rejected_by', rejected), ('seconds', round(seconds, 3)), ('records_per_s', round(rate, 1))])
+    if stderr:
+        sys.stderr.write('records seen: %d, kept: %d, rejected: %d (%s) in %.2f s, %.0f records/s\n' % (summary['seen'], summary['kept'],
+                         summary['rejected'], ', '.join('%s: %d' % x for x in rejected.items()), seconds, rate))
+    if json_path:
+        with open(json_path, 'w') as json_out:
+            json.dump(summary, json_out, indent=2)
+            json_out.write('\n')
+
+def sniff_format(path):
+    '''sam, or bam/cram for compressed or CRAM input, from the first bytes of a file.'''
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'CRAM':
+        return 'cram'
+    if magic[:2] == b'\x1f\x8b':
+        return 'bam'
+    return 'sam'
+
+def pysam_filter(args, criteria):
+    '''filter SAM/BAM/CRAM with pysam, writing SAM/BAM/CRAM with multithreaded BGZF, and return the counts. Records
+    are checked as by filter_batch, and --pairs decides on whole templates in the same way.'''
+    path = '-' if args.input is sys.stdin else args.input.name
+    verbosity = pysam.set_verbosity(0) # quiet htslib looking for a CRAM index, which a stream doesn't need
+    SAMin = pysam.AlignmentFile(path, 'r', threads=args.threads, reference_filename=args.reference)
+    pysam.set_verbosity(verbosity)
+    mode = {'sam': 'wh', 'bam': 'wb', 'cram': 'wc'}[args.outformat]
+    out = pysam.AlignmentFile(args.output, mode, template=SAMin, threads=args.threads, reference_filename=args.reference)
+    checks = compile_checks(criteria, bam=True)
+    counts = dict.fromkeys(('seen', 'kept') + REJECTS, 0)
+    if args.pairs == 'read':
+        for read in SAMin:
+            reason = record_fail(read, checks)
+            tally(counts, [reason])
+            if reason is None:
+                out.write(read)
+    else:
+        recent = OrderedDict()
+        for qname, template in groupby(SAMin, key=lambda read: read.query_name):
+            template = list(template)
+            reasons = [record_fail(read, checks) for read in template]
+            nms = [read.get_tag('NM') if read.has_tag('NM') else 0 for read in template] if args.pairs == 'sum' else None
+            decided = template_reasons(reasons, [not read.flag & 0x900 for read in template], nms, args.nedit)
+            if decided is None:
+                reasons = follow_template(reasons, recent.get(qname), nms, args.nedit)
+            else:
+                reasons = decided
+                remember(recent, qname, not any(reasons), args.window)
+            tally(counts, reasons)
+            for (read, reason) in zip(template, reasons):
+                if reason is None:
+                    out.write(read)
+    out.close()
+    SAMin.close()
+    return counts
+
+def column_filter(SAMfile, nmfield, nedit):
+    '''print the rows of a text SAM file whose NM field at column nmfield is at most nedit, as bwa output.'''
+    SAMin = csv.reader(SAMfile, delimiter = '\t', quoting=csv.QUOTE_NONE)
 
     for row in SAMin:
         try:
-            if '@' in row[0] or int(row[nmfield].strip("NM:i:")) <= args.nedit:
+            if '@' in row[0] or int(row[nmfield].strip("NM:i:")) <= nedit:
                 print('\t'.join(row))
         except IndexError:
             try:
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
 
 import argparse, sys, csv, re
+import multiprocessing
 import numpy as np
-from os.path import exists
+from os.path import exists, getsize
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+CHUNKSIZE = 1 << 24 # bytes of depth input parsed at once by the numpy engine
+FIELDROWS = 1 << 16 # rows of a chunk whose field bytes are gathered at once by field_matrix
+BAMWINDOW = 1 << 22 # bases of BAM coverage tallied at once
+BAMSKIP = 0x704 # unmapped, secondary, qc fail and duplicate reads, as skipped by samtools depth
 
 def main():
 
@@ -10,7 +20,7 @@ def main():
     parser = argparse.ArgumentParser(description='Compare read coverage from BAM/SAM file (requires samtools depth output) against gff annotation. \
         Generates gff output of coverage intervals both non-overlapping and overlapping with gff features \
         (strand info not retained, attributes: ID=seqid_0start|overlapping gff ID;mean cov;median cov;num gaps;overlap type;overlap len;overlap %;).')
-    parser.add_argument('-i', '--indepths', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='samtools depth single sample output file (leave out if using STDIN).')
+    parser.add_argument('-i', '--indepths', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='samtools depth single sample output file (leave out if using STDIN), or bedGraph or indexed BAM/CRAM file (see option -F).')
     parser.add_argument('-g', '--gffref', required=False, help='reference annotation gff file (optional). Only mRNA or gene lines preferred (see option -t). Must contain ID attribute.')
     parser.add_argument('-t', '--typestr', type=str, required=False, help='indicate feature type (as string) to retrieve from reference gff, e.g. mRNA (default=none).')
     parser.add_argument('-m', '--mindep', type=int, required=False, default=2, help='min mean read depth to consider as feature (default=2).')
@@ -20,11 +30,25 @@ def main():
     parser.add_argument('-j', '--jumplen', type=int, required=False, default=500, help='max gap length allowed to extend feature, i.e. introns (default=500).')
     parser.add_argument('-o', '--outname', type=str, required=False, default="out", help='specify output prefix (default="out")')
     parser.add_argument('-s', '--showtypes', help='indicate TRUE to show overlap types.')
+    parser.add_argument('-F', '--informat', choices=['depth', 'bedgraph', 'bam'], default='depth', help='coverage input format: samtools depth rows, bedGraph (e.g. bedtools genomecov -bg) or indexed BAM/CRAM read directly with pysam (default=depth).')
+    parser.add_argument('-r', '--reffasta', type=str, required=False, help='reference fasta for decoding CRAM input (optional if the CRAM header points to it).')
+    parser.add_argument('-E', '--engine', choices=['loop', 'numpy'], default='loop', help='depth parsing engine: loop parses row by row, numpy parses large binary chunks with vectorized run detection (default=loop).')
+    parser.add_argument('-p', '--procs', type=int, required=False, default=1, help='number of processes. Above 1, the depth/bedGraph file (-i, not STDIN) is split at seqid boundaries, or BAM/CRAM split by contig, and processed in parallel (default=1).')
+    parser.add_argument('-S', '--stream', help='indicate TRUE to stream: each coverage feature is written (and compared to the gff) as soon as its run closes instead of after the whole depth input is read.')
     args = parser.parse_args()
 
     ## check input arguments ##
     if args.gffref and not exists(args.gffref):
         sys.exit("Error: " + args.gffref + " not found!\n")
+    if args.procs > 1 and args.indepths is sys.stdin:
+        sys.exit("Error: parallel mode (-p) needs a depth file (-i), not STDIN!\n")
+    if args.engine == 'numpy' and args.informat != 'depth':
+        sys.exit("Error: numpy engine (-E) only parses samtools depth input!\n")
+    if args.informat == 'bam':
+        if not pysam:
+            sys.exit("Error: BAM/CRAM input (-F bam) requires pysam!\n")
+        if args.indepths is sys.stdin:
+            sys.exit("Error: BAM/CRAM input (-F bam) needs an indexed file (-i), not STDIN!\n")
 
     if args.showtypes in ['T', 't', 'True', 'true', 'TRUE']:
         print('''
@@ -56,62 +80,442 @@ def main():
     ''')
 
     fileOut = args.outname + '.gff'
+    stream = args.stream in ['T', 't', 'True', 'true', 'TRUE']
 
-    ## parse depths and record feats to data struct ##
-    indepths = csv.reader(args.indepths, delimiter = '\t', quoting=csv.QUOTE_NONE)
-    line1 = next(indepths)
-    ncol = len(line1) # count num cols
-    if ncol != 3:
-        sys.exit("Error: depth input has incorrect number of columns!")
-    else:
-        seqid = line1[0]
-        runstart = int(line1[1])
-        runend = int(line1[1])
-        depths = [int(line1[2])]
-        gaps = 0
-        covList = [] # coverage feats stored as list of tuples
-        for row in indepths:
-            if row[2] == '0' or int(row[2]) < args.depnuc: #lines with depth 0 (if samtools depth -a/aa is used) or less than min nt depth ignored
-                continue
-            jump = int(row[1]) - runend
-            if row[0] == seqid and jump <= args.jumplen: #maintain feature interval if seqname same, jump less than cutoff
-                seqid = row[0]
-                runend = int(row[1])
-                depths.append(int(row[2]))
-                if jump >= args.gaplen: #count as gap if jump len exceeds gap threshold
-                	gaps += 1
-            else: #do calcs and store expression feature and start new one - reset params when deviate beyond cutoffs
-                runlen = runend - runstart
-                depmean = int(round(np.mean(depths)))
-                depmedian = int(np.median(depths))
-                if runlen >= args.featlen and depmean >= args.mindep:
-                    covList.append((seqid, runstart, runend, depmean, depmedian, gaps))
-                seqid = row[0]
-                runstart = int(row[1])
-                runend = int(row[1])
-                depths = [int(row[2])]
-                gaps = 0
-        covList.append((seqid, runstart, runend, depmean, depmedian, gaps))
+    ## parallel mode: fan seqid blocks of the depth file out to a process pool, merging results in input order ##
+    if args.procs > 1:
+        gffDict = read_gff(args.gffref, args.typestr) if args.gffref else None
+        print("Processing coverage in " + str(args.procs) + " processes...")
+        nfeats, tally = parallel_runs(args, gffDict, fileOut)
+        print_tallies(nfeats, tally)
+        sys.exit()
 
+    ## parse depths to coverage feats, held in memory unless streaming ##
+    if args.informat == 'bam':
+        covFeats = coverage_runs(bam_blocks(args.indepths.name, args), args)
+    elif args.informat == 'bedgraph':
+        covFeats = coverage_runs(bedgraph_blocks(args.indepths), args)
+    elif args.engine == 'numpy':
+        covFeats = numpy_runs(args.indepths.buffer, args)
+    else:
+        covFeats = coverage_runs(depth_rows(args.indepths), args)
+    if not stream:
+        covFeats = list(covFeats) # coverage feats stored as list of tuples
         print("Coverage features recorded.")
 
     ## write out coverage feats as is if no ref gff supplied ##
     if not args.gffref:
         print("Reference gff not supplied. Writing coverage features to " + args.outname + ".gff")
         output = open(fileOut, 'w+')
-        for feat in covList:
-            output.write(feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
-                feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + ";gaps=" + str(feat[5]) + ";\n")
-        print("Finished.\n\nn coverage features: " + str(len(covList)))
+        nfeats = 0
+        for feat in covFeats:
+            output.write(feat_line(feat))
+            nfeats += 1
+        output.close()
+        print_tallies(nfeats, None)
         sys.exit()
 
-    ## if ref gff supplied, write gff feats to data struct ##
+    ## if ref gff supplied, write gff feats to data struct and index them per seqid ##
+    gffDict = read_gff(args.gffref, args.typestr)
+    gffIndex = {}
+    for seqid in gffDict:
+        gffIndex[seqid] = index_features(gffDict[seqid])
+
+    ## compare cov feats to gff feats to find overlaps and write out cov feats with modified attributes ##
+    print("Comparing coverage intervals to gff features...")
+    output = open(fileOut, 'w+')
+    #setup overlap types tally
+    tally = {'null':0, 'tail':0, 'head':0, 'inset':0, 'flank':0, 'exact':0}
+    nfeats = 0
+    for feat in covFeats: #iterate over cov feats, as each one closes if streaming
+        output.write(overlap_feat(feat, gffDict.get(feat[0]), gffIndex.get(feat[0]), tally))
+        nfeats += 1
+    output.close()
+
+    ## print final tallies to console and end ##
+    print_tallies(nfeats, tally)
+
+def print_tallies(nfeats, tally):
+    '''print the feature count, and overlap type tallies if a gff was compared.'''
+    if tally is None:
+        print("Finished.\n\nn coverage features: " + str(nfeats))
+        return
+    print("Finished.\n\nn coverage features: " + str(nfeats) + "\noverlaps with gff features:\nnull=" + str(tally['null']) + "\ntail=" + \
+        str(tally['tail']) + '\nhead=' + str(tally['head']) + '\ninset=' + str(tally['inset']) + '\nflank=' + str(tally['flank']) + '\nexact=' + str(tally['exact']))
+
+def feat_line(feat):
+    '''gff line for a cov feat written as is (no ref gff supplied).'''
+    return feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
+        feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + ";gaps=" + str(feat[5]) + ";\n"
+
+def parallel_runs(args, gffDict, fileOut):
+    '''process seqid blocks of the depth file (or contigs of a BAM) in a pool of args.procs workers and write their
+    gff lines to fileOut in input order. Returns (nfeats, tally), tally being None if no gff was supplied.'''
+    path = args.indepths.name
+    workerArgs = argparse.Namespace(**dict((k, v) for k, v in vars(args).items() if k != 'indepths')) #open files don't pickle
+    if args.informat == 'bam':
+        bam = pysam.AlignmentFile(path, reference_filename=args.reffasta)
+        tasks = [(path, contig) for contig in bam.references]
+        bam.close()
+    else:
+        tasks = [(path, span) for span in seqid_ranges(path)]
+    tally = {'null':0, 'tail':0, 'head':0, 'inset':0, 'flank':0, 'exact':0} if gffDict is not None else None
+    nfeats = 0
+    output = open(fileOut, 'w+')
+    pool = multiprocessing.Pool(args.procs, initializer=init_worker, initargs=(workerArgs, gffDict))
+    for (lines, n, rangeTally) in pool.imap(range_feats, tasks):
+        output.write(lines)
+        nfeats += n
+        if tally is not None:
+            for key in tally:
+                tally[key] += rangeTally[key]
+    pool.close()
+    pool.join()
+    output.close()
+    return (nfeats, tally)
+
+def seqid_ranges(path):
+    '''split a depth file into (start, end) byte ranges, each cut between two rows with different seqids so no
+    coverage run spans ranges. Cuts are found by galloping then bisecting on byte offsets, so the file is not read
+    through; for grouped (sorted) depth output each range holds exactly one seqid.'''
+    size = getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            seqid = line_seqid(f, start)[1]
+            lo = start #row starting at or after lo has seqid
+            step = 1 << 12
+            while lo + step < size and line_seqid(f, lo + step)[1] == seqid:
+                lo += step
+                step <<= 1
+            hi = min(lo + step, size)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if line_seqid(f, mid)[1] == seqid:
+                    lo = mid
+                else:
+                    hi = mid
+            end = line_seqid(f, lo + 1)[0]
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def line_seqid(f, offset):
+    '''return (offset, seqid) of the first depth row starting at or after offset.'''
+    if offset == 0:
+        f.seek(0)
+    else:
+        f.seek(offset - 1)
+        f.readline() #skip to end of row containing offset-1
+    rowStart = f.tell()
+    return (rowStart, f.readline().split(b'\t', 1)[0])
+
+def init_worker(args, gffDict):
+    '''hand each pool worker the parsed arguments and gff feats once, rather than per task.'''
+    global workerArgs, workerGff, workerIndex
+    workerArgs = args
+    workerGff = gffDict
+    workerIndex = {}
+
+def range_feats(task):
+    '''build and write out the coverage feats of one byte range of the depth file in a pool worker.'''
+    path, span = task #span is a contig name for BAM input, otherwise a (start, end) byte range
+    args = workerArgs
+    depthFile = None
+    if args.informat == 'bam':
+        covFeats = coverage_runs(bam_blocks(path, args, span), args)
+    else:
+        depthFile = open(path, 'rb')
+        depthFile.seek(span[0])
+        if args.engine == 'numpy':
+            covFeats = numpy_runs(depthFile, args, limit=span[1]-span[0])
+        elif args.informat == 'bedgraph':
+            covFeats = coverage_runs(bedgraph_blocks(range_lines(depthFile, span[1]-span[0])), args)
+        else:
+            covFeats = coverage_runs(depth_rows(range_lines(depthFile, span[1]-span[0])), args)
+    tally = {'null':0, 'tail':0, 'head':0, 'inset':0, 'flank':0, 'exact':0}
+    nfeats = 0
+    lines = []
+    for feat in covFeats:
+        if workerGff is None:
+            lines.append(feat_line(feat))
+        else:
+            if feat[0] in workerGff and feat[0] not in workerIndex: #index seqids as the worker meets them
+                workerIndex[feat[0]] = index_features(workerGff[feat[0]])
+            lines.append(overlap_feat(feat, workerGff.get(feat[0]), workerIndex.get(feat[0]), tally))
+        nfeats += 1
+    if depthFile:
+        depthFile.close()
+    return (''.join(lines), nfeats, tally)
+
+def range_lines(f, limit):
+    '''yield decoded rows of a binary file from its current position up to limit bytes.'''
+    for line in f:
+        if limit <= 0:
+            break
+        limit -= len(line)
+        yield line.decode()
+
+def depth_rows(handle):
+    '''yield (seqid, start, end, depth) blocks of one base each from samtools depth output.'''
+    indepths = csv.reader(handle, delimiter = '\t', quoting=csv.QUOTE_NONE)
+    for row in indepths:
+        if len(row) != 3:
+            sys.exit("Error: depth input has incorrect number of columns!")
+        pos = int(row[1])
+        yield (row[0], pos, pos, int(row[2]))
+
+def bedgraph_blocks(handle):
+    '''yield (seqid, start, end, depth) blocks (1-based, inclusive) from bedGraph coverage, skipping track/browser lines.'''
+    inbed = csv.reader(handle, delimiter = '\t', quoting=csv.QUOTE_NONE)
+    for row in inbed:
+        if not row or row[0].startswith(('track', 'browser', '#')):
+            continue
+        if len(row) != 4:
+            sys.exit("Error: bedGraph input has incorrect number of columns!")
+        yield (row[0], int(row[1]) + 1, int(row[2]), int(row[3]))
+
+def bam_blocks(path, args, contig=None):
+    '''yield (seqid, start, end, depth) blocks (1-based, inclusive) of constant read depth straight from an indexed
+    BAM/CRAM, for all contigs or just one. Aligned blocks of each read (deletions and introns excluded, as in samtools
+    depth) are tallied as start/end events per window of BAMWINDOW bases, so depth is never expanded per base.'''
+    bam = pysam.AlignmentFile(path, reference_filename=args.reffasta)
+    if not bam.has_index():
+        sys.exit("Error: BAM/CRAM input needs an index (samtools index)!")
+    for (seqid, length) in zip(bam.references, bam.lengths):
+        if contig is not None and seqid != contig:
+            continue
+        for winStart in range(0, length, BAMWINDOW):
+            winEnd = min(winStart + BAMWINDOW, length)
+            starts = []
+            ends = []
+            for read in bam.fetch(seqid, winStart, winEnd):
+                if read.flag & BAMSKIP:
+                    continue
+                for (start, end) in read.get_blocks(): #0-based half open, clipped to window so reads spanning windows count once
+                    if end > winStart and start < winEnd:
+                        starts.append(max(start, winStart))
+                        ends.append(min(end, winEnd))
+            if not starts:
+                continue
+            edges, inverse = np.unique(np.array(starts + ends), return_inverse=True)
+            depths = np.cumsum(np.bincount(inverse, weights=[1] * len(starts) + [-1] * len(ends)).astype(np.int64))
+            for i in np.flatnonzero(depths[:-1]).tolist():
+                yield (seqid, int(edges[i]) + 1, int(edges[i+1]), int(depths[i]))
+    bam.close()
+
+def coverage_runs(rows, args):
+    '''group depth blocks (seqid, start, end, depth), one per base for samtools depth input, into coverage feats, yielding each (seqid, runstart, runend, depmean, depmedian, gaps)
+    passing -l/-m as soon as its run closes. Depths of the open run are tallied in a histogram (depth -> n bases)
+    so memory is bounded by the number of distinct depths rather than the run length.'''
+    seqid = None
+    for (rowid, pos, blockEnd, depth) in rows:
+        if depth == 0 or depth < args.depnuc: #lines with depth 0 (if samtools depth -a/aa is used) or less than min nt depth ignored
+            continue
+        jump = pos - runend if seqid is not None else 0
+        if rowid == seqid and jump <= args.jumplen: #maintain feature interval if seqname same, jump less than cutoff
+            if jump >= args.gaplen: #count as gap if jump len exceeds gap threshold
+                gaps += 1
+        else: #store expression feature and start new one - reset params when deviate beyond cutoffs
+            if seqid is not None:
+                feat = close_run(seqid, runstart, runend, hist, gaps, args)
+                if feat:
+                    yield feat
+            seqid = rowid
+            runstart = pos
+            hist = {}
+            gaps = 0
+        runend = blockEnd
+        hist[depth] = hist.get(depth, 0) + blockEnd - pos + 1
+        if args.gaplen <= 1: #bases within a block are 1 apart
+            gaps += blockEnd - pos
+    if seqid is not None:
+        feat = close_run(seqid, runstart, runend, hist, gaps, args)
+        if feat:
+            yield feat
+
+def numpy_runs(stream, args, chunksize=CHUNKSIZE, limit=None):
+    '''vectorized equivalent of coverage_runs over a binary samtools depth stream read in chunks of whole lines.
+    Run boundaries, gaps and depth filtering are found with diff/cumsum per chunk; the run left open at the end
+    of a chunk is carried over as (seqid, runstart, runend, hist, gaps) and finished by close_run.
+    If limit is given, only that many bytes are read from the stream.'''
+    carry = None
+    for (names, codes, pos, depths) in depth_chunks(stream, chunksize, limit):
+        keep = (depths != 0) & (depths >= args.depnuc) #lines with depth 0 or less than min nt depth ignored
+        codes = codes[keep]
+        pos = pos[keep]
+        depths = depths[keep]
+        if len(pos) == 0:
+            continue
+        jumps = np.diff(pos)
+        breaks = np.empty(len(pos), dtype=bool)
+        breaks[1:] = (np.diff(codes) != 0) | (jumps > args.jumplen)
+        gapped = np.zeros(len(pos), dtype=bool)
+        gapped[1:] = ~breaks[1:] & (jumps >= args.gaplen)
+        #first row either extends the carried run or starts a new one
+        if carry and names[codes[0]] == carry[0] and pos[0] - carry[2] <= args.jumplen:
+            breaks[0] = False
+            gapped[0] = pos[0] - carry[2] >= args.gaplen
+        else:
+            breaks[0] = True
+            if carry:
+                feat = close_run(*carry, args=args)
+                if feat:
+                    yield feat
+                carry = None
+        runStarts = np.flatnonzero(breaks)
+        headEnd = runStarts[0] if len(runStarts) else len(pos)
+        if carry: #rows before the first break belong to the carried run
+            hist = carry[3]
+            for depth, n in zip(*np.unique(depths[:headEnd], return_counts=True)):
+                hist[int(depth)] = hist.get(int(depth), 0) + int(n)
+            carry = (carry[0], carry[1], int(pos[headEnd-1]), hist, carry[4] + int(gapped[:headEnd].sum()))
+            if headEnd == len(pos):
+                continue
+            feat = close_run(*carry, args=args)
+            if feat:
+                yield feat
+        #runs closed within the chunk, all but the last run start
+        if len(runStarts) > 1:
+            rs = runStarts[:-1]
+            re_ = runStarts[1:]
+            counts = re_ - rs
+            runstarts = pos[rs]
+            runends = pos[re_ - 1]
+            means = np.round(np.add.reduceat(depths[rs[0]:re_[-1]], rs - rs[0]) / counts).astype(np.int64)
+            gaps = np.add.reduceat(gapped[rs[0]:re_[-1]].astype(np.int64), rs - rs[0])
+            ok = (runends - runstarts >= args.featlen) & (means >= args.mindep)
+            if ok.any():
+                #median per run: sort depths within runs, average the two middle values
+                runIds = np.repeat(np.arange(len(rs)), counts)
+                region = depths[rs[0]:re_[-1]]
+                ordered = region[np.lexsort((region, runIds))]
+                offsets = rs - rs[0]
+                medians = (ordered[offsets + (counts - 1) // 2] + ordered[offsets + counts // 2]) // 2
+                for i in np.flatnonzero(ok).tolist():
+                    yield (names[codes[rs[i]]], int(runstarts[i]), int(runends[i]), int(means[i]), int(medians[i]), int(gaps[i]))
+        #last run stays open for the next chunk
+        last = runStarts[-1]
+        hist = {}
+        for depth, n in zip(*np.unique(depths[last:], return_counts=True)):
+            hist[int(depth)] = int(n)
+        carry = (names[codes[last]], int(pos[last]), int(pos[-1]), hist, int(gapped[last+1:].sum()))
+    if carry:
+        feat = close_run(*carry, args=args)
+        if feat:
+            yield feat
+
+def depth_chunks(stream, chunksize, limit=None):
+    '''read samtools depth output in binary chunks cut at line ends, yielding (names, codes, pos, depths)
+    where codes index each row's seqid in names.'''
+    tail = b''
+    while True:
+        if limit is not None:
+            chunksize = min(chunksize, limit)
+            limit -= chunksize
+        block = stream.read(chunksize) if chunksize else b''
+        if not block:
+            break
+        block = tail + block
+        cut = block.rfind(b'\n') + 1
+        tail = block[cut:]
+        if cut:
+            yield parse_depth_chunk(block[:cut])
+    if tail.strip():
+        yield parse_depth_chunk(tail + b'\n')
+
+def parse_depth_chunk(buf):
+    '''parse whole lines of samtools depth output to numpy arrays without splitting rows in python.'''
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(arr == 10)
+    tabs = np.flatnonzero(arr == 9)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    if len(tabs) != 2 * len(ends):
+        sys.exit("Error: depth input has incorrect number of columns!")
+    tabs = tabs.reshape(-1, 2)
+    ends = ends - (arr[ends - 1] == 13) #depth field ends before the \r of CRLF lines
+    if not (np.all(tabs[:, 0] > starts) and np.all(tabs[:, 1] < ends)):
+        sys.exit("Error: depth input has incorrect number of columns!")
+    #seqid changes found by comparing zero-padded name fields of adjacent rows
+    names = field_matrix(arr, starts, tabs[:, 0], 'left')
+    changes = np.flatnonzero(np.any(names[1:] != names[:-1], axis=1)) + 1
+    segments = np.zeros(len(ends), dtype=np.int64)
+    segments[changes] = 1
+    segments = np.cumsum(segments)
+    #one code per distinct seqid, so rows of a seqid split by filtered rows of another still compare equal
+    nameCodes = {}
+    segCodes = []
+    for i in np.concatenate(([0], changes)).tolist():
+        segCodes.append(nameCodes.setdefault(buf[starts[i]:tabs[i, 0]].decode(), len(nameCodes)))
+    names = list(nameCodes)
+    codes = np.array(segCodes, dtype=np.int64)[segments]
+    return (names, codes, field_ints(arr, tabs[:, 0] + 1, tabs[:, 1]), field_ints(arr, tabs[:, 1] + 1, ends))
+
+def field_matrix(arr, lo, hi, align):
+    '''gather the bytes of fields arr[lo:hi] into a zero-padded 2D uint8 array, one row per field. Index
+    matrices are built FIELDROWS rows at a time as int32 (chunks are far below 2 GB), so they stay small.'''
+    itype = np.int32 if len(arr) < 2**31 else np.int64
+    width = max(int((hi - lo).max()), 1)
+    cols = np.arange(width, dtype=itype)
+    out = np.empty((len(lo), width), dtype=np.uint8)
+    for a in range(0, len(lo), FIELDROWS):
+        l = lo[a:a + FIELDROWS].astype(itype)[:, None]
+        h = hi[a:a + FIELDROWS].astype(itype)[:, None]
+        if align == 'left':
+            idx = l + cols
+            valid = idx < h
+        else:
+            idx = h - width + cols
+            valid = idx >= l
+        np.copyto(idx, 0, where=~valid)
+        block = arr[idx]
+        block[~valid] = 0
+        out[a:a + FIELDROWS] = block
+    return out
+
+def field_ints(arr, lo, hi):
+    '''parse the decimal fields arr[lo:hi] to an int64 array, one digit column at a time.'''
+    if (hi <= lo).any():
+        sys.exit("Error: depth input has non-integer position or depth!")
+    values = np.zeros(len(lo), dtype=np.int64)
+    for column in field_matrix(arr, lo, hi, 'right').T:
+        digit = np.where(column == 0, 48, column) - 48 #padding counts as a leading zero, other bytes wrap past 9
+        if (digit > 9).any():
+            sys.exit("Error: depth input has non-integer position or depth!")
+        values = values * 10 + digit
+    return values
+
+def close_run(seqid, runstart, runend, hist, gaps, args):
+    '''do calcs on a finished run from its depth histogram. Returns the cov feat, or None if below -l/-m.'''
+    nbases = sum(hist.values())
+    depmean = int(round(sum(depth * n for depth, n in hist.items()) / nbases))
+    if runend - runstart < args.featlen or depmean < args.mindep:
+        return None
+    #median as np.median would give it: mean of the two middle depths when nbases is even
+    lowRank = (nbases - 1) // 2
+    highRank = nbases // 2
+    seen = 0
+    low = None
+    for depth in sorted(hist):
+        seen += hist[depth]
+        if low is None and seen > lowRank:
+            low = depth
+        if seen > highRank:
+            depmedian = (low + depth) // 2
+            break
+    return (seqid, runstart, runend, depmean, depmedian, gaps)
+
+def read_gff(gffref, typestr):
+    '''write gff feats to a dict of (start, end, featid) lists per seqid, keeping file order.'''
     gffDict = {}
-    gffFile = open(args.gffref, 'r')
+    gffFile = open(gffref, 'r')
     gffIn = csv.reader(gffFile, delimiter = '\t', quoting=csv.QUOTE_NONE)
     for row in gffIn:
         try:
-            if args.typestr and args.typestr not in row[2]: #skip row if feature field does not match specified type
+            if typestr and typestr not in row[2]: #skip row if feature field does not match specified type
                 continue
             featid = re.match(r"ID=([^;]+)",row[8]).group(1)
             if row[0] in gffDict:
@@ -122,80 +526,106 @@ def main():
             continue
         #generates something like: {'contig_1':[(210,510,'gene_1'),(1215,3211,'gene_2')],'contig_2':[(123,456,'gene_3'),(789,1112,'gene_4'),...}
     gffFile.close()
+    return gffDict
 
-    ## compare cov feats to gff feats to find overlaps and write out cov feats with modified attributes ##
-    print("Comparing coverage intervals to gff features...")
-    output = open(fileOut, 'w+')
-    #setup overlap types tally
-    null = 0
-    tail = 0
-    head = 0
-    inset = 0
-    flank = 0
-    exact = 0
-    for feat in covList: #iterate over cov feats
-        #feat=(seqid, runstart, runend, depmean, depmedian)
-        if feat[0] in gffDict.keys(): #check if feat id in gff dict, otherwise write out cov feat as is (null type) 
-            featLen = float(feat[2] - feat[1])
-            attID = feat[0] + "_" + str(feat[1]-1) #unless overlap with gff feat is found
-            anymatch = False
+def index_features(feats):
+    '''build an implicit interval tree (cgranges layout) over the gff feats of one seqid.
+    feats is the gffDict list of (start, end, featid) in file order. Returns (starts, ends, maxends, order, level, odd)
+    where starts/ends are sorted by start, maxends holds the max end of each subtree, order maps back to file order
+    and odd lists malformed feats (start > end) that are checked against every cov feat.'''
+    odd = [i for i in range(len(feats)) if feats[i][0] > feats[i][1]]
+    order = sorted([i for i in range(len(feats)) if feats[i][0] <= feats[i][1]], key=lambda i: feats[i][0])
+    starts = [feats[i][0] for i in order]
+    ends = [feats[i][1] for i in order]
+    maxends = list(ends)
+    n = len(order)
+    if n == 0:
+        return (starts, ends, maxends, order, -1, odd)
+    last_i = (n - 1) & ~1 #last leaf
+    last = ends[last_i]
+    k = 1
+    while 1 << k <= n:
+        x = 1 << (k - 1)
+        for i in range((x << 1) - 1, n, x << 2):
+            er = maxends[i + x] if i + x < n else last
+            maxends[i] = max(ends[i], maxends[i - x], er)
+        last_i = last_i - x if last_i >> k & 1 else last_i + x
+        if last_i < n and maxends[last_i] > last:
+            last = maxends[last_i]
+        k += 1
+    return (starts, ends, maxends, order, k - 1, odd)
+
+def query_index(index, qstart, qend):
+    '''return file-order positions of gff feats with start <= qend and end >= qstart, plus any malformed feats.'''
+    starts, ends, maxends, order, level, odd = index
+    n = len(order)
+    hits = list(odd)
+    stack = [((1 << level) - 1, level, False)] if level >= 0 else []
+    while stack:
+        x, k, leftDone = stack.pop()
+        if k <= 3: #small subtree, scan it
+            i = x >> k << k
+            i1 = min(i + (1 << (k + 1)) - 1, n)
+            while i < i1 and starts[i] <= qend:
+                if ends[i] >= qstart:
+                    hits.append(order[i])
+                i += 1
+        elif not leftDone:
+            stack.append((x, k, True))
+            y = x - (1 << (k - 1))
+            if y >= n or maxends[y] >= qstart: #left subtree may hold overlaps
+                stack.append((y, k - 1, False))
+        elif x < n and starts[x] <= qend:
+            if ends[x] >= qstart:
+                hits.append(order[x])
+            stack.append((x + (1 << (k - 1)), k - 1, False))
+    hits.sort()
+    return hits
+
+def overlap_feat(feat, feats, index, tally):
+    '''classify a cov feat against the indexed gff feats of its seqid, update tally and return the gff lines to write.'''
+    #feat=(seqid, runstart, runend, depmean, depmedian, gaps)
+    if not feats: #seqid not in gff, write out cov feat as is (null type)
+        tally['null'] += 1
+        #attributes: ID=seqid_seqstart;mean cov;median cov;overlap type;
+        return feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
+            feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + ";gaps=" + str(feat[5]) + ";type=null;\n"
+    featLen = float(feat[2] - feat[1])
+    lines = []
+    for i in query_index(index, feat[1], feat[2]): #per cov feat, only visit candidate gff feats comparing coords
+        start, end, featid = feats[i]
+        if start < feat[2] <= end and feat[1] < start: #overlap type= tail
+            overlapLen = feat[2] - start
+            overlapPcnt = round((overlapLen/featLen)*100, 1)
+            overlapType = 'tail'
+        elif start <= feat[1] < end and feat[2] > end: #overlap type= head
+            overlapLen = end - feat[1]
+            overlapPcnt = round((overlapLen/featLen)*100, 1)
+            overlapType = 'head'
+        elif start == feat[1] and feat[2] == end: #overlap type= exact
+            overlapLen = int(featLen)
+            overlapPcnt = 100.0
+            overlapType = 'exact'
+        elif start <= feat[1] and feat[2] <= end: #overlap type= inset
+            overlapLen = feat[2] - feat[1]
+            overlapPcnt = 100.0
+            overlapType = 'inset'
+        elif start > feat[1] and feat[2] > end: #overlap type= flank
+            overlapLen = end - start
+            overlapPcnt = round((overlapLen/featLen)*100, 1)
+            overlapType = 'flank'
         else:
-            null += 1
-            #attributes: ID=seqid_seqstart;mean cov;median cov;overlap type;
-            output.write(feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
-                feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + ";gaps=" + str(feat[5]) + ";type=null;\n")
             continue
-        for (start,end,featid) in gffDict[feat[0]]: #per cov feat, iterate over gff feats with matching seqid comparing coords
-                overlapLen = 0
-                overlapPcnt = 0.0
-                overlapType = ''
-                if start < feat[2] <= end and feat[1] < start: #overlap type= tail
-                    tail += 1
-                    overlapLen = feat[2] - start
-                    overlapPcnt = round((overlapLen/featLen)*100, 1)
-                    overlapType = 'tail'
-                    anymatch = True
-                elif start <= feat[1] < end and feat[2] > end: #overlap type= head
-                    head += 1
-                    overlapLen = end - feat[1]
-                    overlapPcnt = round((overlapLen/featLen)*100, 1)
-                    overlapType = 'head'
-                    anymatch = True
-                elif start == feat[1] and feat[2] == end: #overlap type= exact
-                    exact += 1
-                    overlapLen = int(featLen)
-                    overlapPcnt = 100.0
-                    overlapType = 'exact'
-                    anymatch = True
-                elif start <= feat[1] and feat[2] <= end: #overlap type= inset
-                    inset += 1
-                    overlapLen = feat[2] - feat[1]
-                    overlapPcnt = 100.0
-                    overlapType = 'inset'
-                    anymatch = True
-                elif start > feat[1] and feat[2] > end: #overlap type= flank
-                    flank += 1
-                    overlapLen = end - start
-                    overlapPcnt = round((overlapLen/featLen)*100, 1)
-                    overlapType = 'flank'
-                    anymatch = True
-                else:
-                    continue
-                if anymatch == True: #overlap found, write out feat with attributes: ID=featid;cov parent;mean cov;median cov;n gaps;overlap type;overlap len;overlap %;)
-                    attID = featid #from gff line
-                    output.write(feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
-                        attID + ";Parent=" + feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + \
-                        ";gaps=" + str(feat[5]) + ";type=" + overlapType + ";len=" + str(overlapLen) + ";pcnt=" + str(overlapPcnt) + ";\n")
-
-        if anymatch == False: #no overlaps with feat found, write out cov feat as is (null type)
-            #attributes: ID=seqid_seqstart;mean cov;median cov;overlap type;
-            null += 1
-            output.write(feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
-                feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + ";gaps=" + str(feat[5]) + ";type=null;\n")
-
-    ## print final tallies to console and end ##
-    print("Finished.\n\nn coverage features: " + str(len(covList)) + "\noverlaps with gff features:\nnull=" + str(null) + "\ntail=" + \
-        str(tail) + '\nhead=' + str(head) + '\ninset=' + str(inset) + '\nflank=' + str(flank) + '\nexact=' + str(exact))
+        tally[overlapType] += 1
+        #overlap found, write out feat with attributes: ID=featid;cov parent;mean cov;median cov;n gaps;overlap type;overlap len;overlap %;)
+        lines.append(feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
+            featid + ";Parent=" + feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + \
+            ";gaps=" + str(feat[5]) + ";type=" + overlapType + ";len=" + str(overlapLen) + ";pcnt=" + str(overlapPcnt) + ";\n")
+    if not lines: #no overlaps with feat found, write out cov feat as is (null type)
+        tally['null'] += 1
+        return feat[0] + "\t.\tcDNA\t" + str(feat[1]) + "\t" + str(feat[2]) + "\t.\t+\t.\tID=" + \
+            feat[0] + "_" + str(feat[1]-1) + ";mean=" + str(feat[3]) + ";median=" + str(feat[4]) + ";gaps=" + str(feat[5]) + ";type=null;\n"
+    return ''.join(lines)
 
 if __name__ == '__main__':
     main()
@@ -5,13 +5,27 @@
 #!/usr/bin/env python
 
 
-import argparse, csv, sys
+import argparse, csv, sys, tempfile, glob, gzip
+import multiprocessing
+from bisect import insort
+from collections import deque
+from heapq import merge
+from itertools import chain, islice
 from operator import itemgetter
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNKROWS = 200000 # rows filtered at once by the numpy engine, and per task with -proc
+ROWOVERHEAD = 200 # approx bytes held per buffered row besides its text, for -mem accounting
+# typed columns 2-13 as parsed for the cutoffs, in field order
+COLTYPES = [('pcntd', 'f8'), ('alnlen', 'i8'), ('msmtch', 'i8'), ('gpopen', 'i8'), ('qstart', 'i8'), ('q_end', 'i8'), ('sstart', 'i8'), ('s_end', 'i8'), ('evalue', 'f8'), ('bscore', 'f8'), ('qcov', 'i8'), ('qcovhsp', 'i8')]
 
 def main():
 
     parser = argparse.ArgumentParser(description='filter and sort a blastn output (outfmt 6 or 7) based on the cutoffs you want for each parameter. Assumes standard out format with addition of qcovs and qcovhsp occupying fields 13 and 14, but these can be substituted for other output options in the blastn command.')
-    parser.add_argument('-i', '--input', help='indicate input file (as blast tab outfmt 6 or 7)', required=True)
+    parser.add_argument('-i', '--input', help='indicate input file(s) (as blast tab outfmt 6 or 7, optionally gzipped). Several files or quoted glob patterns are filtered as one combined input', nargs='+', required=True)
     parser.add_argument('-o', '--output', help='indicate output file', required=True)
     parser.add_argument('-p', '--pcntid', help='set min percent id', default=0, type=float, required=False)
     parser.add_argument('-a', '--alnlen', help='set min alignment length', default=0, type=int, required=False)
@@ -28,6 +42,11 @@ def main():
     parser.add_argument('-sort1', '--sort1', help='choose primary paramter to sort rows best to worst by entering string value: <qname|sname|pcntd|alnlen|msmtch|gpopen|qstart|q_end|sstart|s_end|evalue|bscore|qcov|qcovhsp>', type=str, required=False)
     parser.add_argument('-sort2', '--sort2', help='choose secondary paramter to sort rows best to worst by entering string value: <qname|sname|pcntd|alnlen|msmtch|gpopen|qstart|q_end|sstart|s_end|evalue|bscore(default)|qcov|qcovhsp>', type=str, required=False)
     parser.add_argument('-topq', '--gettopq', help='set number of top hits per query to output. Top hits based on preferred sort parameter - must use sort option', type=int, required=False)
+    parser.add_argument('-grp', '--grouped', help='indicate True if input is grouped by query, as written by BLAST. Top hits per query (-topq) are then selected and written as each query block ends (at a query id change or "# Query:" line) instead of after the whole input, with output in input query order', required=False)
+    parser.add_argument('-mem', '--memlimit', help='approx memory (MB) for buffering rows when sorting without top hits. Beyond this, sorted runs are spilled to temp files and merged (default=2048)', default=2048, type=float, required=False)
+    parser.add_argument('-tmp', '--tmpdir', help='directory for sort spill files (default=system temp dir)', type=str, required=False)
+    parser.add_argument('-proc', '--procs', help='number of processes to filter chunks of rows in parallel (default=1)', default=1, type=int, required=False)
+    parser.add_argument('-eng', '--engine', help='filtering engine: loop converts row by row, numpy loads chunks of rows into typed arrays and applies all cutoffs as vectorized masks (default=loop)', choices=['loop', 'numpy'], default='loop', required=False)
     parser.add_argument('-tops', '--gettops', help='set number of top hits per subject to output. Top hits based on preferred sort parameter - must use sort option', type=int, required=False)
     args = parser.parse_args()
 
@@ -50,7 +69,6 @@ def main():
     coldex = {'qname':(0, False), 'sname':(1, False), 'pcntd':(2,True), 'alnlen':(3,True), 'msmtch':(4,False), 'gpopen':(5,False), 'qstart':(6,False), 'q_end':(7,False), 'sstart':(8,False), 's_end':(9,False), 'evalue':(10,False), 'bscore':(11,True), 'qcov':(12,True), 'qcovhsp':(13,True)}
     if args.sort1:
         param1 = coldex[args.sort1] # col to sort is param1[0], ascend or descend is param1[1]
-        sortLst = []
     else:
         print('Primary sort not given - output will be unsorted.')
 
@@ -62,122 +80,273 @@ def main():
     if args.gettopq and args.gettops:
         sys.exit('abort: cannot run both -topq and -tops. Choose one.')
 
-    with open(args.input, 'r') as file_in:
-        print('Parsing ' + args.input + '...')
-        file_out = open(args.output, 'w+')
-        file_out.write('#This output based on arguments: \n' + '#input file=' + args.input + '\n#output file=' + args.output + '\n#min percent id=' + str(args.pcntid) + '\n#min alignment length=' + str(args.alnlen) + '\n#max mismatches=' + str(args.msmtch) + '\n#max gap opens=' + str(args.gpopen) + '\n#min query seq start=' + str(args.qstart) + '\n#max query seq end=' + str(args.q_end) + '\n#min subject seq start=' + str(args.sstart) + '\n#max subject seq end=' + str(args.s_end) + '\n#max evalue=' + str(args.evalue) + '\n#min bit score=' + str(args.bscore) + '\n#min pcnt query cov=' + str(args.qcov) + '\n#min pcnt query cov hsp=' + str(args.qcovhsp) + '\n')
+    if args.engine == 'numpy' and not np:
+        sys.exit('abort: numpy engine requires numpy.')
+
+    grouped = args.grouped in ['T', 't', 'True', 'true', 'TRUE']
+    if grouped and not (args.sort1 and args.gettopq):
+        sys.exit('abort: grouped input (-grp) is for top hits per query. Use with -sort1 and -topq.')
+    if grouped and args.procs > 1:
+        sys.exit('abort: grouped input (-grp) filters one query block at a time and cannot use -proc. Choose one.')
+
+    inputs = expand_inputs(args.input)
+    file_in = chain.from_iterable(read_input(path) for path in inputs)
+    with open(args.output, 'w+') as file_out:
+        file_out.write('#This output based on arguments: \n' + '#input file=' + ', '.join(inputs) + '\n#output file=' + args.output + '\n#min percent id=' + str(args.pcntid) + '\n#min alignment length=' + str(args.alnlen) + '\n#max mismatches=' + str(args.msmtch) + '\n#max gap opens=' + str(args.gpopen) + '\n#min query seq start=' + str(args.qstart) + '\n#max query seq end=' + str(args.q_end) + '\n#min subject seq start=' + str(args.sstart) + '\n#max subject seq end=' + str(args.s_end) + '\n#max evalue=' + str(args.evalue) + '\n#min bit score=' + str(args.bscore) + '\n#min pcnt query cov=' + str(args.qcov) + '\n#min pcnt query cov hsp=' + str(args.qcovhsp) + '\n')
         file_out.write('#Fields: query id, subject id, % identity, alignment length, mismatches, gap opens, q. start, q. end, s. start, s. end, evalue, bit score, qcov, qcovhsp \n')
         count = 0
-        reader = csv.reader(file_in, delimiter = '\t')
-        for row in reader:
-            if '#' in row[0]:
-                continue
-            idxError = 0
-            while idxError <= 13:
-                try:
-                    if all([float(row[2])>=args.pcntid, int(row[3])>=args.alnlen, int(row[4])<=args.msmtch, int(row[5])<=args.gpopen, int(row[6])>=args.qstart, int(row[7])<=args.q_end, int(row[8])>=args.sstart, int(row[9])<=args.s_end, float(row[10])<=args.evalue, float(row[11])>=args.bscore, int(row[12])>=args.qcov, int(row[13])>=args.qcovhsp]):
-                        if args.sort1:
-                            sortLst.append(row)
-                        else:
-                            file_out.write(str('\t'.join(row)) + '\n')
-                        count += 1
-                except IndexError:
-                    row.append('0')
-                    idxError += 1
-                    continue
-                break
-        
-        if args.sort1:
-            def force_type(x):
-                try:
-                    return(int(x))
-                except ValueError:
-                    try:
-                        return(float(x))
-                    except ValueError:
-                        return(x)
-
-            sortLst = [[force_type(x) for x in row] for row in sortLst]
-            sortLst.sort(key=itemgetter(param2[0]), reverse=param2[1])
-            sortLst.sort(key=itemgetter(param1[0]), reverse=param1[1])
+        if args.engine == 'numpy':
+            filter_rows = numpy_filter
+        else:
+            filter_rows = loop_filter
+        if grouped:
+            pass # filtered block by block below
+        elif args.procs > 1:
+            passing = parallel_filter(file_in, args)
+        else:
+            passing = filter_rows(file_in, args)
 
-            if args.gettopq:
-                qnames = {}
-                tally = 0
+        if grouped:
+            # one query block in memory at a time, its top hits written as soon as it ends
+            tally = 0
+            for block in query_blocks(file_in):
                 topLst = []
-                if args.sort1 == 'qname':
-                    for row in sortLst:
-                        if row[0] not in qnames.keys():
-                            qnames[row[0]] = 1
-                            file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                            tally += 1
-                        elif qnames[row[0]] < args.gettopq:
-                            qnames[row[0]] += 1
-                            file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                            tally += 1
-                        else:
-                            continue
-                    print('Wrote %d top hits out of %d matches to %s' %(tally, count, args.output))
-                else:
-                    for row in sortLst:
-                        if row[0] not in qnames.keys():
-                            qnames[row[0]] = 1
-                            topLst.append(row)
-                            tally += 1
-                        elif qnames[row[0]] < args.gettopq:
-                            qnames[row[0]] += 1
-                            topLst.append(row)
-                            tally += 1
-                        else:
-                            continue
-                    if args.gettopq > 1:
-                        topLst.sort(key=itemgetter(0), reverse=False)
-                    for row in topLst:
-                        file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                    print('Wrote %d top hits out of %d matches to %s' %(tally, count, args.output))
-            elif args.gettops:
-                snames = {}
-                tally = 0
-                topLst = []
-                if args.sort1 == 'sname':
-                    for row in sortLst:
-                        if row[1] not in snames.keys():
-                            snames[row[1]] = 1
-                            file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                            tally += 1
-                        elif snames[row[1]] < args.gettops:
-                            snames[row[1]] += 1
-                            file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                            tally += 1
-                        else:
-                            continue
-                    print('Wrote %d top hits out of %d matches to %s' %(tally, count, args.output))
-                else:
-                    for row in sortLst:
-                        if row[1] not in snames.keys():
-                            snames[row[1]] = 1
-                            topLst.append(row)
-                            tally += 1
-                        elif snames[row[1]] < args.gettops:
-                            snames[row[1]] += 1
-                            topLst.append(row)
-                            tally += 1
-                        else:
-                            continue
-                    if args.gettops > 1:
-                        topLst.sort(key=itemgetter(1), reverse=False)
-                    for row in topLst:
-                        file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                    print('Wrote %d top hits out of %d matches to %s' %(tally, count, args.output))
+                for row in filter_rows(block, args):
+                    fields = row.split('\t')
+                    topLst.append(((sort_key(fields, param1), sort_key(fields, param2), count), fields))
+                    count += 1
+                topLst.sort(key=itemgetter(0))
+                for (key, fields) in topLst[:args.gettopq]:
+                    file_out.write(str('\t'.join(str(force_type(x)) for x in fields)) + '\n')
+                tally += len(topLst[:args.gettopq])
+            print('Wrote %d top hits out of %d matches to %s' %(tally, count, args.output))
+        elif args.sort1 and (args.gettopq or args.gettops):
+            # keep only the best n rows per query (or subject) while streaming
+            if args.gettopq:
+                groupCol, topn, sortGroup = 0, args.gettopq, args.sort1 == 'qname'
             else:
-                for row in sortLst:
-                    file_out.write(str('\t'.join(str(x) for x in row)) + '\n')
-                print('Wrote %d matches to %s' %(count, args.output))
+                groupCol, topn, sortGroup = 1, args.gettops, args.sort1 == 'sname'
+            best = {}
+            for row in passing:
+                fields = row.split('\t')
+                keep_top(best, fields[groupCol], (sort_key(fields, param1), sort_key(fields, param2), count), fields, topn)
+                count += 1
+            topLst = [hit for hits in best.values() for hit in hits]
+            del(best)
+            topLst.sort(key=itemgetter(0))
+            if not sortGroup and topn > 1:
+                topLst.sort(key=lambda hit: force_type(hit[1][groupCol]))
+            for (key, fields) in topLst:
+                file_out.write(str('\t'.join(str(force_type(x)) for x in fields)) + '\n')
+            print('Wrote %d top hits out of %d matches to %s' %(len(topLst), count, args.output))
+        elif args.sort1:
+            for row in external_sort(passing, param1, param2, int(args.memlimit * 1024 * 1024), args.tmpdir):
+                file_out.write(row + '\n')
+                count += 1
+            print('Wrote %d matches to %s' %(count, args.output))
         else:
+            for row in passing:
+                file_out.write(row + '\n')
+                count += 1
             print('Wrote %d matches to %s' %(count, args.output))
-        file_out.close()
         
 
+def expand_inputs(patterns):
+    '''expand glob patterns among the input names, keeping the given order.'''
+    inputs = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                sys.exit('abort: no input files match ' + pattern)
+            inputs.extend(matches)
+        else:
+            inputs.append(pattern)
+    return inputs
+
+def read_input(path):
+    '''yield the lines of an input file, decompressing gzipped (.gz) files.'''
+    print('Parsing ' + path + '...')
+    if path.endswith('.gz'):
+        file_in = gzip.open(path, 'rt')
+    else:
+        file_in = open(path, 'r')
+    with file_in:
+        for line in file_in:
+            yield line
+
+def parallel_filter(lines, args):
+    '''filter chunks of CHUNKROWS lines across args.procs worker processes, yielding passing rows in input order.
+    At most two chunks per worker are in flight, so memory stays bounded however large the input.'''
+    pool = multiprocessing.Pool(args.procs, initializer=init_worker, initargs=(args,))
+    pending = deque()
+    while True:
+        chunk = list(islice(lines, CHUNKROWS))
+        if not chunk:
+            break
+        pending.append(pool.apply_async(filter_chunk, (chunk,)))
+        if len(pending) >= 2 * args.procs:
+            for row in pending.popleft().get():
+                yield row
+    while pending:
+        for row in pending.popleft().get():
+            yield row
+    pool.close()
+    pool.join()
+
+def init_worker(args):
+    '''hand each pool worker the parsed arguments once.'''
+    global workerArgs
+    workerArgs = args
+
+def filter_chunk(chunk):
+    '''filter a chunk of lines in a pool worker, returning the passing rows.'''
+    if workerArgs.engine == 'numpy':
+        return list(numpy_filter(chunk, workerArgs))
+    return list(loop_filter(chunk, workerArgs))
+
+def force_type(x):
+    try:
+        return(int(x))
+    except ValueError:
+        try:
+            return(float(x))
+        except ValueError:
+            return(x)
+
+def sort_key(fields, param):
+    '''typed value of the sort column, negated for best-first columns so all keys sort ascending.'''
+    value = force_type(fields[param[0]])
+    return -value if param[1] else value
+
+def external_sort(rows, param1, param2, memlimit, tmpdir):
+    '''yield rows sorted by param1 then param2 (stable), as tab-joined typed values. Rows are buffered up to
+    memlimit bytes, then each buffer is sorted and spilled to a temp file and the runs are k-way merged.'''
+    runs = []
+    buf = []
+    size = 0
+    for idx, row in enumerate(rows):
+        fields = row.split('\t')
+        buf.append(((sort_key(fields, param1), sort_key(fields, param2), idx), '\t'.join(str(force_type(x)) for x in fields)))
+        size += len(row) + ROWOVERHEAD
+        if size >= memlimit:
+            runs.append(spill_run(buf, tmpdir))
+            buf = []
+            size = 0
+    buf.sort(key=itemgetter(0))
+    if not runs:
+        for (key, row) in buf:
+            yield row
+        return
+    # typed values re-type to themselves, so run rows can be re-keyed; merge takes earlier runs first on ties
+    def row_key(row):
+        fields = row.split('\t')
+        return (sort_key(fields, param1), sort_key(fields, param2))
+    tail = (row for (key, row) in buf)
+    for row in merge(*[iter_run(run) for run in runs] + [tail], key=row_key):
+        yield row
+    for run in runs:
+        run.close()
+
+def spill_run(buf, tmpdir):
+    '''sort buffered (key, row) pairs and write the rows to a temp file, returned rewound.'''
+    buf.sort(key=itemgetter(0))
+    run = tempfile.TemporaryFile(mode='w+', dir=tmpdir)
+    run.writelines(row + '\n' for (key, row) in buf)
+    run.seek(0)
+    return run
+
+def iter_run(run):
+    '''yield the rows of a spilled run.'''
+    for line in run:
+        yield line.rstrip('\n')
+
+def keep_top(best, group, key, fields, topn):
+    '''keep the topn lowest-keyed rows of each group in best, a dict of bounded (key, fields) lists in key order.
+    key ends with the input row number, so ties keep input order as in a stable sort.'''
+    hits = best.get(group)
+    if hits is None:
+        best[group] = [(key, fields)]
+    elif len(hits) < topn:
+        insort(hits, (key, fields))
+    elif key < hits[-1][0]:
+        hits.pop()
+        insort(hits, (key, fields))
+
+def query_blocks(file_in):
+    '''yield the data lines of each query block of grouped BLAST output. Blocks end at a change of query id or
+    at an outfmt 7 "# Query:" line; other comment lines are dropped.'''
+    block = []
+    qname = None
+    for line in file_in:
+        if line.startswith('# Query:'):
+            if block:
+                yield block
+            block = []
+            qname = None
+            continue
+        name = line.split('\t', 1)[0]
+        if '#' in name or not line.strip():
+            continue
+        if name != qname and block:
+            yield block
+            block = []
+        qname = name
+        block.append(line)
+    if block:
+        yield block
+
+def loop_filter(file_in, args):
+    '''yield rows passing all cutoffs as tab-joined strings, missing trailing fields filled with 0.'''
+    reader = csv.reader(file_in, delimiter = '\t')
+    for row in reader:
+        if '#' in row[0]:
+            continue
+        idxError = 0
+        while idxError <= 13:
+            try:
+                if all([float(row[2])>=args.pcntid, int(row[3])>=args.alnlen, int(row[4])<=args.msmtch, int(row[5])<=args.gpopen, int(row[6])>=args.qstart, int(row[7])<=args.q_end, int(row[8])>=args.sstart, int(row[9])<=args.s_end, float(row[10])<=args.evalue, float(row[11])>=args.bscore, int(row[12])>=args.qcov, int(row[13])>=args.qcovhsp]):
+                    yield '\t'.join(row)
+            except IndexError:
+                row.append('0')
+                idxError += 1
+                continue
+            break
+
+def numpy_filter(file_in, args):
+    '''same as loop_filter, but rows are loaded CHUNKROWS at a time into a structured array of the typed columns
+    and cutoffs applied as vectorized masks. Missing trailing fields are found once per chunk from the first row
+    and filled with 0 for the whole chunk; chunks with ragged rows fall back to loop_filter.'''
+    file_in = iter(file_in)
+    while True:
+        chunk = list(islice(file_in, CHUNKROWS))
+        if not chunk:
+            break
+        rows = [line.rstrip('\n') for line in chunk if line.strip() and '#' not in line.split('\t', 1)[0]]
+        if not rows:
+            continue
+        ncol = rows[0].count('\t') + 1
+        if ncol < 3 or ncol < 14 and sum(row.count('\t') for row in rows) != (ncol - 1) * len(rows):
+            for row in loop_filter(rows, args):
+                yield row
+            continue
+        usecols = list(range(2, min(ncol, 14)))
+        try:
+            cols = np.loadtxt(rows, delimiter='\t', usecols=usecols, dtype=COLTYPES[:len(usecols)], comments=None, ndmin=1)
+        except ValueError: #ragged or non numeric rows, let the loop engine handle (or fail on) them as before
+            for row in loop_filter(rows, args):
+                yield row
+            continue
+        zeros = np.zeros(len(rows), dtype=np.int64)
+        col = lambda name: cols[name] if name in cols.dtype.names else zeros
+        mask = (col('pcntd') >= args.pcntid) & (col('alnlen') >= args.alnlen) & (col('msmtch') <= args.msmtch) & (col('gpopen') <= args.gpopen) & \
+            (col('qstart') >= args.qstart) & (col('q_end') <= args.q_end) & (col('sstart') >= args.sstart) & (col('s_end') <= args.s_end) & \
+            (col('evalue') <= args.evalue) & (col('bscore') >= args.bscore) & (col('qcov') >= args.qcov) & (col('qcovhsp') >= args.qcovhsp)
+        pad = '\t0' * (14 - ncol) if ncol < 14 else ''
+        for i in np.flatnonzero(mask).tolist():
+            yield rows[i] + pad
+
+
 if __name__ == '__main__':
     main()
 
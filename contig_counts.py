@@ -1,114 +1,242 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
+import json
+import multiprocessing
 import numpy as np
+import os
 import re
+import sys
+from fasta_io import fasta_spans, record_ranges, compression
+
+NONWORD = bytes(c for c in range(256) if not re.match(b'\\w', bytes([c]))) # bytes not counted as residues (regex \W)
+WORD = np.array([c not in NONWORD for c in range(256)]) # byte values counted as residues
+CACHEHASH = 1 << 20 # bytes hashed from each end of a fasta to fingerprint it for the stats cache
+SPLITSIZE = 1 << 28 # uncompressed fasta above this many bytes are split across processes
+BINLIMS = (0, 500, 1000, 2000, 5000, 8000, 12000, 20000, 40000, 60000, 100000, 200000, 500000, 1000000, 3000000, 6000000, 10000000, 20000000, float('inf'))
+BINDEX = ('0-0.5Kb', '0.5-1Kb', '1-2Kb', '2-5Kb', '5-8Kb', '8-12Kb', '12-20Kb', '20-40Kb', '40-60Kb', '60-100Kb', '100-200Kb', '200-500Kb', '0.5-1Mb', '1-3Mb', '3-6Mb', '6-10Mb', '10-20Mb', '20Mb+')
 
 def main():
-    
+
     # Parse arguments.
-    parser = argparse.ArgumentParser(description='get contig counts and stats from a multi-fasta file')
-    parser.add_argument('-i', '--input', help='indicate input fasta', required=True)
+    parser = argparse.ArgumentParser(description='get contig counts and stats from one or more multi-fasta files')
+    parser.add_argument('-i', '--input', help='indicate input fasta, or several to report on each', nargs='+', required=True)
     parser.add_argument('-s', '--show', help='print id of each contig above this length. Indicate min length', type=int, required=False)
     parser.add_argument('-b', '--bins', help='indicate True to print binned contig lengths', required=False)
+    parser.add_argument('-x', '--nx', help='x values to report Nx and Lx (and NGx, LGx) for, e.g. 10 20 30 40 50 60 70 80 90. Default is 25 50 75', nargs='+', default=[25, 50, 75], type=float, required=False)
+    parser.add_argument('-g', '--genome', help='expected genome size in bp, to report NGx and LGx', type=int, required=False)
+    parser.add_argument('-p', '--procs', help='number of processes. Inputs, and parts of uncompressed fasta larger than 256Mb, are counted in parallel (default=1)', default=1, type=int, required=False)
+    parser.add_argument('-f', '--format', help='report format: commented text per input, or one tsv or json table with a row of all stats and length bins per input (default=text)', choices=['text', 'tsv', 'json'], default='text', required=False)
+    parser.add_argument('-o', '--output', help='write the tsv/json table to this file instead of STDOUT', required=False)
+    parser.add_argument('-c', '--cache', help='indicate True to keep the contig lengths and counts of each fasta in a <fasta>.stats.npz file alongside it, and reuse them (with any -s/-b/-x/-g options) while the fasta is unchanged', required=False)
     args = parser.parse_args()
-    
-    # establish params
-    ctgLens = []
-    p = re.compile('(>.+\n)|\W')
-    N = re.compile('[nN]')
-    Ns = 0
-    if args.show:
-        show = True
+    bins = args.bins in ['T', 't', 'True', 'true', 'TRUE']
+    cache = args.cache in ['T', 't', 'True', 'true', 'TRUE']
+
+    # Load cached counts, then split the other inputs into tasks, one per fasta or per part of a large uncompressed fasta
+    counted = dict((path, ([], np.zeros(256, np.int64), [], [])) for path in args.input)
+    show = 0 if cache else args.show # when caching, keep every contig id so any -s can be answered later
+    tasks = []
+    for path in args.input:
+        cached = load_cache(path) if cache else None
+        if cached:
+            lengths, counts, gapLens, shown = cached
+            counted[path] = ([lengths], counts, [gapLens], shown)
+        elif args.procs > 1 and not compression(path) and os.path.getsize(path) > SPLITSIZE:
+            parts = min(args.procs, os.path.getsize(path) // SPLITSIZE + 1)
+            tasks += [(path, start, end, show) for (start, end) in record_ranges(path, parts)]
+        else:
+            tasks.append((path, 0, None, show))
+
+    # Count contigs, merging parts in input order
+    if args.procs > 1:
+        pool = multiprocessing.Pool(args.procs)
+        results = pool.imap(count_contigs, tasks)
     else:
-        show = False
-    if args.bins in ['T', 't', 'True', 'true', 'TRUE']:
-        bins = True
-        binLims = (0, 500, 1000, 2000, 5000, 8000, 12000, 20000, 40000, 60000, 100000, 200000, 500000, 1000000, 3000000, 6000000, 10000000, 20000000, float('inf'))
-        binCounts = {0:0, 1:0, 2:0, 3:0, 4:0, 5:0, 6:0, 7:0, 8:0, 9:0, 10:0, 11:0, 12:0, 13:0, 14:0, 15:0, 16:0, 17:0}
-        binDex = ('0-0.5Kb', '0.5-1Kb', '1-2Kb', '2-5Kb', '5-8Kb', '8-12Kb', '12-20Kb', '20-40Kb', '40-60Kb', '60-100Kb', '100-200Kb', '200-500Kb', '0.5-1Mb', '1-3Mb', '3-6Mb', '6-10Mb', '10-20Mb', '20Mb+')
+        pool = None
+        results = map(count_contigs, tasks)
+    for (task, (lengths, counts, gapLens, shown)) in zip(tasks, results):
+        ctgLens, ctgCounts, ctgGaps, ctgShown = counted[task[0]]
+        ctgLens.append(lengths)
+        ctgCounts += counts
+        ctgGaps.append(gapLens)
+        ctgShown += shown
+    if pool:
+        pool.close()
+        pool.join()
+    if cache:
+        for path in set(task[0] for task in tasks):
+            ctgLens, counts, gapLens, shown = counted[path]
+            save_cache(path, np.concatenate(ctgLens), counts, np.concatenate(gapLens), shown)
+
+    # Report.
+    report = []
+    for path in args.input:
+        ctgLens, counts, gapLens, shown = counted[path]
+        for (ctgid, seqLen) in shown:
+            if not args.show or seqLen < args.show:
+                continue
+            print(ctgid + '\t' + str(seqLen), file=sys.stdout if args.format == 'text' else sys.stderr)
+        stats = assembly_stats(path, np.concatenate(ctgLens), counts, np.concatenate(gapLens), args.nx, args.genome)
+        if args.format == 'text':
+            print_stats(stats, bins, args.nx, args.genome)
+        report.append(stats)
+    if args.format != 'text':
+        out = open(args.output, 'w') if args.output else sys.stdout
+        write_table(report, out, args.format)
+        if args.output:
+            out.close()
+
+def count_contigs(task):
+    '''count the residues of each contig in one fasta, or one byte range of it, in a single pass. Returns
+    (lengths, counts, gapLens, shown): contig lengths, the count of each byte value over all contig sequence,
+    the lengths of runs of Ns and (id, length) of contigs of at least the show length (none if show is None).
+    Counts are taken straight from the raw byte spans, no sequence is built.'''
+    path, start, end, show = task
+    lengths = []
+    shown = []
+    counts = np.zeros(256, np.int64)
+    gapLens = []
+    gapOpen = 0 # length of a run of Ns reaching the end of the last span
+    seqLen = None # no contig yet, sequence before the first header is not counted
+    for header, span in fasta_spans(path, start=start, end=end):
+        if header is None:
+            if seqLen is None:
+                continue
+            spanCounts = np.bincount(np.frombuffer(span, np.uint8), minlength=256)
+            residues = int(spanCounts[WORD].sum())
+            seqLen += residues
+            counts += spanCounts
+            if spanCounts[78] or spanCounts[110]:
+                gapOpen = gap_runs(bytes(span).translate(None, NONWORD), gapOpen, gapLens)
+            elif gapOpen and residues:
+                gapLens.append(gapOpen)
+                gapOpen = 0
+            continue
+        if seqLen is not None:
+            lengths.append(seqLen)
+            if show is not None and seqLen >= show:
+                shown.append((ctgid, seqLen))
+        if gapOpen:
+            gapLens.append(gapOpen)
+            gapOpen = 0
+        ctgid = header.rstrip(b'\r\n').decode().lstrip('>')
+        seqLen = 0
+    if seqLen is not None:
+        lengths.append(seqLen)
+        if show is not None and seqLen >= show:
+            shown.append((ctgid, seqLen))
+    if gapOpen:
+        gapLens.append(gapOpen)
+    return (np.array(lengths, np.int64), counts, np.array(gapLens, np.int64), shown)
+
+def gap_runs(residues, gapOpen, gapLens):
+    '''add the lengths of runs of N/n in residues to gapLens, the first continuing a run of gapOpen before it.
+    Returns the length of the run reaching the end of residues, left open as the next span may continue it.'''
+    isN = np.frombuffer(residues.upper(), np.uint8) == 78
+    edges = np.flatnonzero(np.diff(np.concatenate(([gapOpen > 0], isN, [False])).astype(np.int8)))
+    if gapOpen:
+        edges = np.concatenate(([-gapOpen], edges))
+    runStarts = edges[0::2]
+    runEnds = edges[1::2]
+    if isN[-1]:
+        gapOpen = len(isN) - runStarts[-1]
+        runStarts = runStarts[:-1]
+        runEnds = runEnds[:-1]
     else:
-        bins = False
-    # Open FASTA.
-    with open(args.input, 'r') as fastaIn:
-        tempSeq = ''
-        ctgid = 'null'
-        for line in fastaIn:
-            if line.startswith('>'):
-                seqLen = len(tempSeq)
-                if show and seqLen >= args.show:
-                    print(ctgid.strip('>') + '\t' + str(seqLen))
-                ctgid = line.strip('\n')
-                if bins:
-                    i = 0
-                    while i < 18:
-                        if binLims[i] < seqLen <= binLims[i+1]:
-                            binCounts[i] += 1
-                            break
-                        i += 1
-                ctgLens.append(seqLen)
-                Ns += len(N.findall(tempSeq))
-                tempSeq = ''
-            else:
-                tempSeq += p.sub('', line)
-        ctgLens.append(len(tempSeq))
-        Ns += len(N.findall(tempSeq))
-        if show and seqLen >= args.show:
-            print(ctgid.strip('>') + '\t' + str(len(tempSeq)) + '\n')
-        if bins:
-            i = 0
-            while i < 18:
-                if binLims[i] < len(tempSeq) <= binLims[i+1]:
-                    binCounts[i] += 1
-                    break
-                i += 1
-        del(tempSeq)
-    
-    ctgLens.pop(0)
-    ctgLens.sort(reverse=True)
-    ctgCount = len(ctgLens)
-    totalLen = sum(ctgLens)
-    ctgMax = max(ctgLens)
-    ctgMin = min(ctgLens)
-    ctgAvg = int(round(np.mean(ctgLens)))
-    ctgMed = int(round(np.median(ctgLens)))
-    ctgStd = round(np.std(ctgLens), 2)
-    len25 = totalLen/4
-    check25 = False
-    N25 = ''
-    len50 = len25*2
-    check50 = False
-    N50 = ''
-    len75 = len25*3
-    N75 = ''
-    rollSum = 0
-    countL = 0
-    L25 = ''
-    L50 = ''
-    L75 = ''
-    for num in ctgLens:
-        rollSum += num
-        countL += 1
-        if check25 == False and rollSum >= len25:
-            N25 = str(num)
-            L25 = str(countL)
-            check25 = True
-        if check50 == False and rollSum >= len50:
-            N50 = str(num)
-            L50 = str(countL)
-            check50 = True
-        if rollSum >= len75:
-            N75 = str(num)
-            L75 = str(countL)
-            break
-
-
-    print('# for ' + args.input + ':\n# number of contigs = ' + str(ctgCount) + '\n# combined length = ' + str(totalLen) + 'bp\n# max length = ' + str(ctgMax) + 'bp\n# min length = ' + str(ctgMin) + 'bp\n# average length = ' + str(ctgAvg) + 'bp\n# median length = ' + str(ctgMed) + 'bp\n# SD = ' + str(ctgStd) + '\n# Ns = ' + str(Ns) + '\n# N25 = ' + N25 + '\n# N50 = ' + N50 + '\n# N75 = ' + N75 + '\n# L25 = ' + L25 + '\n# L50 = ' + L50 + '\n# L75 = ' + L75 + '\n#')
+        gapOpen = 0
+    gapLens += (runEnds - runStarts).tolist()
+    return gapOpen
+
+def fingerprint(path):
+    '''identify the current content of a fasta cheaply, by its full path, size, mtime and a hash of the
+    CACHEHASH bytes at each end.'''
+    st = os.stat(path)
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        digest.update(f.read(CACHEHASH))
+        f.seek(max(st.st_size - CACHEHASH, 0))
+        digest.update(f.read(CACHEHASH))
+    return '%s\t%d\t%d\t%s' % (os.path.abspath(path), st.st_size, st.st_mtime_ns, digest.hexdigest())
+
+def load_cache(path):
+    '''return the (lengths, counts, gapLens, shown) of a fasta from its stats cache, or None if there is no cache
+    or the fasta has changed since it was written.'''
+    try:
+        with np.load(path + '.stats.npz') as cached:
+            if str(cached['fingerprint']) != fingerprint(path):
+                return None
+            lengths = cached['lengths']
+            ids = [x.rstrip('\r') for x in bytes(cached['ids']).decode().split('\n')] if len(lengths) else [] # ids of older caches may end in \r
+            return (lengths, cached['counts'], cached['gaps'], list(zip(ids, lengths.tolist())))
+    except (IOError, KeyError, ValueError):
+        return None
+
+def save_cache(path, lengths, counts, gapLens, shown):
+    '''write the stats cache of a fasta, holding every contig length and id along with its byte value counts and
+    N run lengths. Failing to write it (e.g. a read only directory) only warns.'''
+    ids = np.frombuffer('\n'.join(ctgid for (ctgid, seqLen) in shown).encode(), np.uint8)
+    tmp = path + '.stats.tmp.npz'
+    try:
+        np.savez_compressed(tmp, fingerprint=fingerprint(path), lengths=lengths, counts=counts, gaps=gapLens, ids=ids)
+        os.replace(tmp, path + '.stats.npz')
+    except (IOError, OSError) as e:
+        print('warning: could not write stats cache for %s: %s' % (path, e), file=sys.stderr)
+
+def assembly_stats(path, ctgLens, counts, gapLens, nx, genome):
+    '''summary stats of one assembly, in report order, from its contig lengths, byte value counts and N run
+    lengths. Nx/Lx (and NGx/LGx given the genome size) are read off one cumulative sum of the sorted lengths.'''
+    ctgLens = np.sort(ctgLens)[::-1]
+    totalLen = int(ctgLens.sum())
+    Ns = int(counts[ord('N')] + counts[ord('n')])
+    gc = int(sum(counts[ord(b)] for b in 'GCgc'))
+    acgt = int(sum(counts[ord(b)] for b in 'ACGTacgt'))
+    stats = {'assembly': path, 'contigs': len(ctgLens), 'length': totalLen, 'max': int(ctgLens.max()), 'min': int(ctgLens.min()),
+        'mean': int(round(np.mean(ctgLens))), 'median': int(round(np.median(ctgLens))), 'sd': round(float(np.std(ctgLens)), 2), 'Ns': Ns}
+    rollSum = np.cumsum(ctgLens)
+    for (k, size) in (('', totalLen), ('G', genome)):
+        if size is None:
+            continue
+        at = np.searchsorted(rollSum, [size * x / 100 for x in nx]) # first contig taking the running sum to x% of size
+        for (x, i) in zip(nx, at):
+            stats['N' + k + '%g' % x] = int(ctgLens[i]) if i < len(ctgLens) else ''
+        for (x, i) in zip(nx, at):
+            stats['L' + k + '%g' % x] = int(i) + 1 if i < len(ctgLens) else ''
+    stats['auN'] = round(float((ctgLens.astype(np.float64) ** 2).sum() / totalLen), 2) if totalLen else ''
+    stats['GC'] = round(100.0 * gc / acgt, 2) if acgt else ''
+    stats['gaps'] = len(gapLens)
+    stats['max gap'] = int(gapLens.max()) if len(gapLens) else 0
+    binOf = np.searchsorted(BINLIMS, ctgLens) - 1 # bin i holds lengths above BINLIMS[i] up to BINLIMS[i+1], 0 in none
+    binCounts = np.bincount(binOf[binOf >= 0], minlength=18)
+    for i in range(18):
+        stats[BINDEX[i]] = int(binCounts[i])
+    return stats
+
+def print_stats(stats, bins, nx, genome):
+    '''print the stats of one assembly as commented text.'''
+    print('# for ' + stats['assembly'] + ':\n# number of contigs = ' + str(stats['contigs']) + '\n# combined length = ' + str(stats['length']) + 'bp\n# max length = ' + str(stats['max']) + 'bp\n# min length = ' + str(stats['min']) + 'bp\n# average length = ' + str(stats['mean']) + 'bp\n# median length = ' + str(stats['median']) + 'bp\n# SD = ' + str(stats['sd']) + '\n# Ns = ' + str(stats['Ns']))
+    for k in (['', 'G'] if genome else ['']):
+        for x in nx:
+            print('# N' + k + '%g = ' % x + str(stats['N' + k + '%g' % x]))
+        for x in nx:
+            print('# L' + k + '%g = ' % x + str(stats['L' + k + '%g' % x]))
+    print('# auN = ' + str(stats['auN']) + '\n# GC = ' + str(stats['GC']) + '%\n# gaps = ' + str(stats['gaps']) + '\n# max gap = ' + str(stats['max gap']) + 'bp\n#')
     if bins:
         print('# length ranges:')
         for i in range(18):
-            print('# ' + str(binDex[i]) + ' = ' + str(binCounts[i]))
+            print('# ' + str(BINDEX[i]) + ' = ' + str(stats[BINDEX[i]]))
         print('\n')
 
+def write_table(report, out, fmt):
+    '''write the stats of every assembly to out as a tsv with one row per assembly, or a json list.'''
+    if fmt == 'json':
+        json.dump(report, out, indent=1)
+        out.write('\n')
+        return
+    out.write('\t'.join(report[0].keys()) + '\n')
+    for stats in report:
+        out.write('\t'.join(str(v) for v in stats.values()) + '\n')
+
 if __name__ == '__main__':
     main()
@@ -2,6 +2,9 @@
 
 
 import argparse
+import os
+import re
+from fasta_io import fasta_spans, open_fasta
 
 
 def main():
@@ -15,13 +18,12 @@ def main():
     parser.add_argument('-z', '--zfill', help='include leading zeros. Indicate min digit length', default=0, type=int, required=False)
     parser.add_argument('-s', '--startn', help='indicate starting number. Default = 1', default=1, type=int, required=False)
     parser.add_argument('-k', '--keep', help='indicate True to keep original names but add prefix and/or suffix', default=False, type=bool, required=False)
+    parser.add_argument('-m', '--mapping', help='write a tab delimited table of old and new contig names (first word of each header) to this file', required=False)
+    parser.add_argument('-a', '--annot', help='GFF/GTF, BED or BLAST tab files to rename contigs in with the same mapping. Each is written to <name>.renamed.<ext>. Contig names are replaced in column 1, or columns 1 and 2 (query and subject) for other tables', nargs='+', required=False)
     args = parser.parse_args()
 
-    # Open FASTA.
-    fasta_in = open(args.input, 'r')
-
     # Create FASTA output file.
-    fasta_out = open(args.output, 'w')
+    fasta_out = open(args.output, 'wb')
 
     # Start counter.
     if args.startn:
@@ -29,35 +31,91 @@ def main():
     else:
         count = 1
 
-    # Parse file and write to output.
+    # Parse file and write to output. Sequence is copied as the raw byte spans read, only headers are rewritten
     print('Parsing %s...' % args.input)
 
     if args.keep == True:
         if not args.prefix:
             args.prefix = ''
-        for line in fasta_in.readlines():
-            if line.startswith('>'):
-                nuline = line.strip('>')
-                contig_id = '>' + args.prefix + nuline.strip('\n') + args.suffix + '\n'
-                fasta_out.write(contig_id)
-                count += 1
-            else:
-                fasta_out.write(line)
     else:
         if not args.prefix:
             args.prefix = 'contig_'
-        for line in fasta_in.readlines():
-            if line.startswith('>'):
-                contig_id = '>' + args.prefix + str(count).zfill(args.zfill) + args.suffix + '\n'
-                fasta_out.write(contig_id)
-                count += 1
-            else:
-                fasta_out.write(line)
+    mapping = {}
+    map_out = open(args.mapping, 'w') if args.mapping else None
+    for line, span in fasta_spans(args.input):
+        if line is None:
+            fasta_out.write(span)
+            continue
+        end = '\r\n' if line.endswith(b'\r\n') else '\n' # as the sequence lines, copied unchanged
+        if args.keep == True:
+            nuline = line.decode().strip('>')
+            contig_id = '>' + args.prefix + nuline.rstrip('\r\n') + args.suffix + end
+        else:
+            contig_id = '>' + args.prefix + str(count).zfill(args.zfill) + args.suffix + end
+        fasta_out.write(contig_id.encode())
+        count += 1
+        if map_out or args.annot:
+            old_name = first_word(line.decode())
+            new_name = first_word(contig_id)
+            mapping[old_name] = new_name
+            if map_out:
+                map_out.write(old_name + '\t' + new_name + '\n')
+    if map_out:
+        map_out.close()
 
     # Finish.
     fasta_out.close()
-    fasta_in.close()
     print('Wrote %d contigs to %s.' % (count-args.startn, args.output))
+    if args.mapping:
+        print('Wrote old and new contig names to %s.' % args.mapping)
+
+    # Rename contigs in companion tables.
+    for table in args.annot or []:
+        stem, ext = os.path.splitext(table[:-3] if table.endswith('.gz') else table)
+        table_out = stem + '.renamed' + ext
+        renamed = rename_table(table, table_out, mapping, 1 if ext.lower() in ['.gff', '.gff3', '.gtf', '.bed'] else 2)
+        print('Renamed %d lines of %s to %s.' % (renamed, table, table_out))
+
+
+def first_word(header):
+    '''contig name of a header line, as used by annotation tables: the first word after the >.'''
+    words = header[1:].split()
+    return words[0] if words else ''
+
+
+def rename_table(table, table_out, mapping, columns):
+    '''write table to table_out with contig names in its first columns (1 for GFF/BED, 2 for BLAST query and
+    subject) swapped for their new names. Comment lines are kept, except GFF ##sequence-region lines are renamed,
+    as are the headers of any ##FASTA section. Returns the number of lines changed.'''
+    renamed = 0
+    in_fasta = False
+    with open_fasta(table) as table_in, open(table_out, 'w') as out:
+        for line in table_in:
+            nuline = line
+            if in_fasta:
+                if line.startswith('>'):
+                    old_name = first_word(line)
+                    if old_name in mapping:
+                        i = line.index(old_name, 1) # after any spaces following the >
+                        nuline = line[:i] + mapping[old_name] + line[i + len(old_name):]
+            elif line.startswith('##sequence-region'):
+                f = re.split(r'(\s+)', line) # separators kept, so the line is rejoined as it was
+                if len(f) > 2 and f[2] in mapping:
+                    f[2] = mapping[f[2]]
+                    nuline = ''.join(f)
+            elif line.startswith('##FASTA'):
+                in_fasta = True
+            elif not line.startswith('#'):
+                f = line.split('\t')
+                for i in range(min(columns, len(f))):
+                    name = f[i].rstrip('\n')
+                    if name in mapping:
+                        f[i] = mapping[name] + f[i][len(name):]
+                nuline = '\t'.join(f)
+            if nuline != line:
+                renamed += 1
+            out.write(nuline)
+    return renamed
 
 
 if __name__ == '__main__':
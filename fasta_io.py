@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+'''shared fasta input for contig_counts.py, contig_namer.py and get_contigs.py. Plain, gzip and bgzip
+compressed fasta are opened the same way; bgzip files can also be read at random via their .gzi index.'''
+
+import gzip
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_right
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+GZMAGIC = b'\x1f\x8b'
+BLOCKSIZE = 1 << 22 # bytes of fasta read at once by fasta_spans
+
+def compression(path):
+    '''return None for an uncompressed file, 'bgzf' for a bgzip file and 'gzip' for any other gzip file.'''
+    with open(path, 'rb') as f:
+        head = f.read(18)
+    if head[:2] != GZMAGIC:
+        return None
+    if len(head) == 18 and head[3] & 4 and head[12:14] == b'BC': # FEXTRA holding the BGZF block size subfield
+        return 'bgzf'
+    return 'gzip'
+
+def open_fasta(path, mode='r', threads=1):
+    '''open a plain or gzip/bgzip compressed fasta for reading in text (r) or binary (rb) mode. Compressed
+    input is decompressed on a separate thread with python-isal when it is installed.'''
+    if not compression(path):
+        return open(path, mode)
+    mode = 'rt' if mode == 'r' else mode
+    if igzip_threaded is not None:
+        return igzip_threaded.open(path, mode, threads=threads)
+    return gzip.open(path, mode)
+
+def fasta_spans(path, blocksize=BLOCKSIZE, start=0, end=None):
+    '''yield the fasta at path as (header, None) for each header line (raw bytes, newline included) and
+    (None, span) for the sequence bytes that follow, as memoryviews of blocks of blocksize, newlines included.
+    A record's sequence may come as several spans; sequence lines are never split out or joined.
+    start and end restrict an uncompressed fasta to a byte range, as from record_ranges.'''
+    prev = b'\n' # byte before the current block, so headers are found as newline + '>'
+    pending = b'' # header line continuing into the next block
+    with open_fasta(path, 'rb') as fasta_in:
+        if start:
+            fasta_in.seek(start)
+        left = end - start if end is not None else -1
+        while left:
+            block = fasta_in.read(blocksize if left < 0 else min(blocksize, left))
+            left -= len(block) if left > 0 else 0
+            if not block:
+                break
+            data = prev + pending + block
+            view = memoryview(data)
+            pending = b''
+            i = 1
+            while True:
+                h = data.find(b'\n>', i - 1) + 1
+                if h == 0:
+                    if i < len(data):
+                        yield None, view[i:]
+                    break
+                if i < h:
+                    yield None, view[i:h]
+                e = data.find(b'\n', h) + 1
+                if e == 0:
+                    pending = data[h:]
+                    break
+                yield data[h:e], None
+                i = e
+            prev = b'\n' if pending else data[-1:]
+    if pending: # last header has no newline
+        yield pending, None
+
+def record_ranges(path, parts):
+    '''split an uncompressed fasta into at most parts (start, end) byte ranges of similar size, each cut at the
+    start of a header line so no record spans ranges.'''
+    size = os.path.getsize(path)
+    cuts = [0]
+    with open(path, 'rb') as fasta_in:
+        for k in range(1, parts):
+            fasta_in.seek(max(k * size // parts, cuts[-1]))
+            fasta_in.readline() # to the start of the next line
+            while True:
+                offset = fasta_in.tell()
+                line = fasta_in.readline()
+                if not line or line.startswith(b'>'):
+                    break
+            if offset > cuts[-1] and offset < size:
+                cuts.append(offset)
+    cuts.append(size)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+def seekable(path):
+    '''True if byte ranges of the uncompressed fasta can be read without decompressing from the start.'''
+    return compression(path) != 'gzip'
+
+def fasta_reader(path):
+    '''return read(start, end), giving bytes start to end of the uncompressed fasta, and close(). Plain files
+    are memory mapped; bgzip files are read block by block from the offsets in their .gzi index.'''
+    if compression(path) == 'bgzf':
+        return bgzf_reader(path)
+    fasta_in = open(path, 'rb')
+    if os.path.getsize(path) == 0:
+        return (lambda start, end: b''), fasta_in.close
+    mm = mmap.mmap(fasta_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close():
+        mm.close()
+        fasta_in.close()
+
+    return (lambda start, end: mm[start:end]), close
+
+def bgzf_reader(path):
+    '''fasta_reader for a bgzip file. The last decompressed block is kept, as reads tend to run in file order.'''
+    blocks = [(0, 0)] + load_gzi(path)
+    starts = [u for (c, u) in blocks]
+    raw = open(path, 'rb')
+    cached = [-1, b'']
+
+    def block(k):
+        if cached[0] != k:
+            raw.seek(blocks[k][0])
+            cached[:] = [k, zlib.decompress(raw.read(bgzf_block_size(raw, blocks[k][0])), 31)]
+        return cached[1]
+
+    def read(start, end):
+        parts = []
+        k = bisect_right(starts, start) - 1
+        pos = start
+        while pos < end and k < len(blocks):
+            part = block(k)[pos - starts[k]:end - starts[k]]
+            parts.append(part)
+            pos += len(part)
+            k += 1
+        return b''.join(parts)
+
+    return read, raw.close
+
+def bgzf_block_size(raw, offset):
+    '''size in bytes of the bgzf block at offset, from the BC subfield of its gzip header.'''
+    raw.seek(offset)
+    head = raw.read(12)
+    if len(head) < 12 or head[:2] != GZMAGIC:
+        return 0
+    extra = raw.read(struct.unpack('<H', head[10:12])[0])
+    raw.seek(offset)
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b'BC':
+            return struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+        i += 4 + slen
+    return 0
+
+def load_gzi(path):
+    '''read the (compressed, uncompressed) offsets of every bgzf block after the first from path.gzi, building it
+    first if missing or stale.'''
+    gzi = path + '.gzi'
+    if not os.path.exists(gzi) or os.path.getmtime(gzi) < os.path.getmtime(path):
+        print('indexing %s...' % path)
+        build_gzi(path, gzi)
+    with open(gzi, 'rb') as gzi_in:
+        n = struct.unpack('<Q', gzi_in.read(8))[0]
+        pairs = struct.unpack('<%dQ' % (2 * n), gzi_in.read(16 * n))
+    return list(zip(pairs[0::2], pairs[1::2]))
+
+def build_gzi(path, gzi):
+    '''write a bgzip compatible .gzi for path. Only block headers and trailers are read, nothing is decompressed.'''
+    entries = []
+    coffset = 0
+    uoffset = 0
+    with open(path, 'rb') as raw:
+        while True:
+            size = bgzf_block_size(raw, coffset)
+            if not size:
+                break
+            raw.seek(coffset + size - 4)
+            isize = struct.unpack('<I', raw.read(4))[0]
+            if coffset and isize: # as bgzip, leave out the empty end of file block
+                entries.append((coffset, uoffset))
+            coffset += size
+            uoffset += isize
+    with open(gzi, 'wb') as gzi_out:
+        gzi_out.write(struct.pack('<Q', len(entries)))
+        for entry in entries:
+            gzi_out.write(struct.pack('<QQ', *entry))
@@ -2,7 +2,11 @@
 
 
 import argparse
+import collections
+import os
 import re
+import sys
+from fasta_io import open_fasta, fasta_spans, seekable, fasta_reader
 
 def main():
 
@@ -15,14 +19,50 @@ def main():
     parser.add_argument('-s', '--strid', help='identifier string before contig number. Default is <contig_> (only compatible if using -t)', default='contig_', type=str, required=False)
     parser.add_argument('-g', '--getnames', help='enter output file name to get a list of non-redundant contig names from <-t> input', required=False)
     parser.add_argument('-v', '--invert', help='indicate True to retrieve contigs NOT in list provided by --table', default=False, type=bool, required=False)
+    parser.add_argument('-d', '--demux', help='demultiplex into one output fasta per bucket in a single pass. Provide files of contig ids, either two column (id, bucket) or one id per line (bucket named after the file). -o is then the output directory', nargs='+', required=False)
+    parser.add_argument('-m', '--maxopen', help='maximum number of bucket output files held open at once with --demux. Default is 64', default=64, type=int, required=False)
+    parser.add_argument('-x', '--index', help='indicate True to use a samtools style .fai index (built on first use if not present) and copy matching contigs straight from their byte offsets', required=False)
     args = parser.parse_args()
+    indexed = args.index in ['T', 't', 'True', 'true', 'TRUE']
+    if indexed and not seekable(args.input):
+        print('%s is gzip but not bgzip compressed, so cannot be read via its index. Scanning instead' % args.input)
+        indexed = False
 
-    # Open FASTA.
-    fasta_in = open(args.input, 'r')
     count = 0
-    matched = 0
+    id_pattern = re.compile(args.strid + r'(\w+)[\.\s,|>:;-]') # contig id after the strid prefix in headers
 
-    if args.list and not args.table:
+    if args.demux and (args.list or args.table):
+        print('error: cannot accept list (-l) or table (-t) with --demux. Choose one and try again')
+
+    elif args.demux:
+        buckets = read_buckets(args.demux, args.strid)
+        names = set(b for x in buckets.values() for b in x)
+        print('%d contig ids assigned to %d buckets from %s' % (len(buckets), len(names), ', '.join(args.demux)))
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        print('demultiplexing contigs in %s to %s...' % (args.input, args.output))
+        written = dict((b, 0) for b in names)
+
+        def route_bucket(line):
+            found = id_pattern.search(line)
+            if not found:
+                return []
+            hits = buckets.get(found.group(1), [])
+            for b in hits:
+                written[b] += 1
+            return hits
+
+        output, close_all = bucket_files(args.output, args.maxopen)
+        if indexed:
+            count = write_indexed(args.input, route_bucket, output)
+        else:
+            count = write_scanned(args.input, route_bucket, output)
+        close_all()
+        for b in sorted(names):
+            print('%s\t%d' % (b, written[b]))
+        print('Wrote %d contigs to %d buckets in %s' % (count, len(names), args.output))
+
+    elif args.list and not args.table:
         fasta_out = open(args.output, 'w+')
         
         # append user defined numbers with regex anchors
@@ -30,18 +70,25 @@ def main():
         print('searching for contigs in %s with exact values inputted: \n %s' % (args.input, query_str))
 
         # Parse file and write to output.
+        # numbers are matched as whole digit runs (non-digit before, whitespace after) looked up in a set,
+        # equivalent to the anchored regex above without testing every number against every header
+        if all(x.isdigit() for x in args.list):
+            numbers = set(args.list)
+            digit_runs = re.compile(r'(?<=\D)\d+(?=\s)')
+            found = lambda line: any(x in numbers for x in digit_runs.findall(line))
+        else:
+            found = lambda line: re.search(query_str, line)
 
-        for line in fasta_in:
-           if line.startswith('>'):
-               if re.search(query_str, line):
-                   print('found')
-                   fasta_out.write(line)
-                   count += 1
-                   matched = 1
-               else:
-                   matched = 0
-           elif matched == 1:
-               fasta_out.write(line)
+        def match_list(line):
+            if found(line):
+                print('found')
+                return True
+            return False
+
+        if indexed:
+            count = write_indexed(args.input, lambda line: [0] if match_list(line) else [], lambda key: fasta_out.buffer)
+        else:
+            count = write_scanned(args.input, lambda line: [0] if match_list(line) else [], lambda key: fasta_out.buffer)
         
         # Finish.
         fasta_out.close()
@@ -53,7 +100,7 @@ def main():
         print('populating list of queries...')
 
         #retrieve contigs from fasta_in based on list in args.table
-        search_term = '(' + args.strid + '\\w+)[\.\\s,|>:;-]'
+        search_term = '(' + args.strid + r'\w+)[\.\s,|>:;-]'
         query_get = re.findall(search_term, table_in.read())
         query_raw = [re.sub(args.strid, '', x, count=1) for x in query_get]
         query_set = list(set(query_raw))
@@ -71,26 +118,18 @@ def main():
             print('searching for contigs in %s that match to contents of %s' % (args.input, args.table))
         else:
             print('searching for contigs in %s that do not match to contents of %s' % (args.input, args.table))
-        p = re.compile(args.strid + '(\w+)[\.\\s,|>:;-]')
-        
-        for line in fasta_in:
-            if line.startswith('>'):
-                matched = 0
-                try:
-                    if not args.invert and p.search(line).group(1) in query_hash:
-                        fasta_out.write(line)
-                        count += 1
-                        matched = 1
-                    elif args.invert and p.search(line).group(1) not in query_hash:
-                        fasta_out.write(line)
-                        count += 1
-                        matched = 1
-                    else:
-                        matched = 0
-                except:
-                    pass
-            elif matched == 1:
-                fasta_out.write(line)
+
+        def match_table(line):
+            found = id_pattern.search(line)
+            if not found: # headers without an id are skipped either way
+                return False
+            return (found.group(1) in query_hash) != bool(args.invert)
+
+        if indexed:
+            count = write_indexed(args.input, lambda line: [0] if match_table(line) else [], lambda key: fasta_out.buffer)
+        else:
+            count = write_scanned(args.input, lambda line: [0] if match_table(line) else [], lambda key: fasta_out.buffer)
+        fasta_out.close()
         if not args.invert:
             print('Wrote %d contigs of %d listed in %s to %s' % (count, num_queries, args.table, args.output))
         else:
@@ -102,6 +141,138 @@ def main():
     elif args.list and args.table:
         print('error: cannot accept both list (-l) and table (-t). Choose one and try again')
 
+def write_scanned(fasta, route, output):
+    '''write each contig to the outputs its header line is routed to, scanning the whole fasta.
+    route(line) returns a list of output keys (empty to skip the contig) and output(key) the binary stream to write to.
+    Only header lines are decoded; sequence is copied as the raw byte spans read.
+    Returns the number of contigs written.'''
+    count = 0
+    keep = []
+    for header, span in fasta_spans(fasta):
+        if header is not None:
+            keep = route(header.decode())
+            count += bool(keep)
+            span = header
+        for key in keep:
+            output(key).write(span)
+    return count
+
+def write_indexed(fasta, route, output):
+    '''write each contig to the outputs its header line is routed to (as for write_scanned), in file order, by
+    seeking to them via the .fai index. Only header lines and matching sequence bytes are read, from a memory map
+    of the fasta or the blocks of a bgzip fasta that hold them. Returns the number of contigs written.'''
+    entries = load_index(fasta)
+    count = 0
+    read, close = fasta_reader(fasta)
+    end = 0 # end of the previous sequence, so the header is the last line before offset
+    for (name, length, offset, linebases, linewidth) in entries:
+        before = read(end, offset)
+        header = before[before.rfind(b'\n', 0, len(before) - 1) + 1:]
+        end = offset + seq_bytes(length, linebases, linewidth)
+        keep = route(header.decode())
+        if not keep:
+            continue
+        seq = read(offset, end)
+        for key in keep:
+            out = output(key)
+            out.write(header)
+            out.write(seq)
+        count += 1
+    close()
+    return count
+
+def read_buckets(tables, strid):
+    '''map contig id (without the strid prefix) to the list of buckets it goes to from tables of either
+    id and bucket columns or one id per line, the latter bucketed under the table file name.'''
+    buckets = {}
+    for table in tables:
+        stem = os.path.splitext(os.path.basename(table))[0]
+        with open(table, 'r') as table_in:
+            for line in table_in:
+                f = line.split()
+                if not f or f[0].startswith('#'):
+                    continue
+                contig = f[0][len(strid):] if f[0].startswith(strid) else f[0]
+                bucket = f[1] if len(f) > 1 else stem
+                hits = buckets.setdefault(contig, [])
+                if bucket not in hits:
+                    hits.append(bucket)
+    return buckets
+
+def bucket_files(outdir, maxopen):
+    '''return output(bucket), giving the binary stream for outdir/bucket.fasta, and close_all(). At most maxopen
+    files are held open; the least recently written is closed to make room and reopened for append when needed.'''
+    handles = collections.OrderedDict()
+    started = set()
+
+    def output(bucket):
+        out = handles.get(bucket)
+        if out is not None:
+            handles.move_to_end(bucket)
+            return out
+        if len(handles) >= maxopen:
+            handles.popitem(last=False)[1].close()
+        out = open(os.path.join(outdir, bucket + '.fasta'), 'ab' if bucket in started else 'wb')
+        started.add(bucket)
+        handles[bucket] = out
+        return out
+
+    def close_all():
+        while handles:
+            handles.popitem()[1].close()
+
+    return output, close_all
+
+def seq_bytes(length, linebases, linewidth):
+    '''bytes spanned by a sequence of length bases written linebases per line of linewidth bytes.'''
+    if length == 0:
+        return 0
+    lines, rem = divmod(length, linebases)
+    return lines * linewidth + (rem + linewidth - linebases if rem else 0)
+
+def load_index(fasta):
+    '''read the (name, length, offset, linebases, linewidth) entries of fasta.fai, building it first if missing or stale.'''
+    fai = fasta + '.fai'
+    if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta):
+        print('indexing %s...' % fasta)
+        build_index(fasta, fai)
+    entries = []
+    with open(fai, 'r') as fai_in:
+        for line in fai_in:
+            f = line.split('\t')
+            entries.append((f[0], int(f[1]), int(f[2]), int(f[3]), int(f[4])))
+    return entries
+
+def build_index(fasta, fai):
+    '''write a samtools compatible .fai for fasta. As with samtools faidx, every line of a sequence but the last
+    must hold the same number of bases.'''
+    entries = []
+    entry = None
+    offset = 0
+    with open_fasta(fasta, 'rb') as fasta_in:
+        for line in fasta_in:
+            if line.startswith(b'>'):
+                if entry:
+                    entries.append(entry)
+                words = line[1:].split()
+                entry = [words[0].decode() if words else '', 0, offset + len(line), 0, 0]
+                short = False
+            elif entry:
+                bases = len(line.rstrip(b'\r\n'))
+                if entry[3] == 0:
+                    entry[3] = bases
+                    entry[4] = len(line) if line.endswith(b'\n') else bases + 1
+                elif short or bases > entry[3]:
+                    sys.exit('error: %s has lines of different lengths in %s, cannot index' % (fasta, entry[0]))
+                short = bases < entry[3]
+                entry[1] += bases
+            offset += len(line)
+    if entry:
+        entries.append(entry)
+    with open(fai, 'w') as fai_out:
+        for entry in entries:
+            fai_out.write('\t'.join(str(x) for x in entry) + '\n')
+
 
 if __name__ == '__main__':
     main()